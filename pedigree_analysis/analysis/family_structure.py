@@ -0,0 +1,126 @@
+"""This module contains vectorized functions describing the family structure of a pedigree"""
+
+import numpy as np
+import pandas as pd
+from preprocessing.pedigree_graph import PedigreeGraph
+
+
+def _get_graph(pedigree: pd.DataFrame, id_col: str, sire_col: str, dam_col: str,
+               graph: PedigreeGraph) -> PedigreeGraph:
+    """Return the given graph or build one from the pedigree"""
+    if graph is None:
+        graph = PedigreeGraph.from_frame(pedigree, id_col=id_col, sire_col=sire_col, dam_col=dam_col)
+    return graph
+
+
+def _group_table(graph: PedigreeGraph, key: np.ndarray, members: np.ndarray,
+                 key_cols: dict, min_size: int = 2) -> pd.DataFrame:
+    """
+    Group animals by an integer key in one sort and return a long table of the groups.
+    Args:
+        graph: pedigree graph
+        key: int64 group key of every member
+        members: dense indices of the animals to group
+        key_cols: output column name -> dense parent index of every member
+        min_size: smallest group size to keep
+    Returns:
+        df: one row per member with the group columns, group number and group size
+    """
+    _, group, size = np.unique(key, return_inverse=True, return_counts=True)
+    group_size = size[group]
+    keep = group_size >= min_size
+    order = np.argsort(group[keep], kind="stable")
+
+    table = {col: graph.id_of(idx[keep][order]) for col, idx in key_cols.items()}
+    table["id"] = graph.id_of(members[keep][order])
+    table["group"] = np.unique(group[keep][order], return_inverse=True)[1]
+    table["group_size"] = group_size[keep][order]
+    return pd.DataFrame(table)
+
+
+def calc_trios(pedigree: pd.DataFrame, id_col: str = "horse_id", sire_col: str = "sire_id",
+               dam_col: str = "dam_id", bed_col: str = "bed_id",
+               graph: PedigreeGraph = None) -> pd.DataFrame:
+    """
+    Find animals whose sire and dam are both genotyped.
+    Args:
+        pedigree: pedigree dataframe
+        id_col, sire_col, dam_col: names of the animal and parent id columns
+        bed_col: name of the column with the genotype id, missing for non-genotyped animals
+        graph: pedigree graph built from the pedigree, it is built here if not provided
+    Returns:
+        df: one row per trio with id, sire_id, dam_id and whether the offspring is genotyped too
+    """
+    graph = _get_graph(pedigree, id_col, sire_col, dam_col, graph)
+    genotyped = pd.notna(graph.node_values(pedigree[bed_col]))
+
+    sire, dam = graph.sire_idx, graph.dam_idx
+    both_known = (sire >= 0) & (dam >= 0)
+    trio = both_known & genotyped[np.where(sire >= 0, sire, 0)] & genotyped[np.where(dam >= 0, dam, 0)]
+    child = np.flatnonzero(trio)
+
+    return pd.DataFrame({"id": graph.id_of(child),
+                         "sire_id": graph.id_of(sire[child]),
+                         "dam_id": graph.id_of(dam[child]),
+                         "genotyped": genotyped[child]})
+
+
+def calc_siblings(pedigree: pd.DataFrame, id_col: str = "horse_id", sire_col: str = "sire_id",
+                  dam_col: str = "dam_id", graph: PedigreeGraph = None) -> tuple:
+    """
+    Group animals into maternal half-sib, paternal half-sib and full-sib families.
+    Args:
+        pedigree: pedigree dataframe
+        id_col, sire_col, dam_col: names of the animal and parent id columns
+        graph: pedigree graph built from the pedigree, it is built here if not provided
+    Returns:
+        tuple: (maternal, paternal, full) long tables with one row per member of a family
+               with more than one offspring; columns are the parent id(s), id, group and group_size
+    """
+    graph = _get_graph(pedigree, id_col, sire_col, dam_col, graph)
+    sire, dam = graph.sire_idx, graph.dam_idx
+
+    with_dam = np.flatnonzero(dam >= 0)
+    maternal = _group_table(graph, dam[with_dam].astype(np.int64), with_dam,
+                            {"dam_id": dam[with_dam]})
+
+    with_sire = np.flatnonzero(sire >= 0)
+    paternal = _group_table(graph, sire[with_sire].astype(np.int64), with_sire,
+                            {"sire_id": sire[with_sire]})
+
+    with_both = np.flatnonzero((sire >= 0) & (dam >= 0))
+    full_key = sire[with_both].astype(np.int64) * graph.n + dam[with_both]
+    full = _group_table(graph, full_key, with_both,
+                        {"sire_id": sire[with_both], "dam_id": dam[with_both]})
+
+    return maternal, paternal, full
+
+
+def calc_half_sibling_counts(pedigree: pd.DataFrame, id_col: str = "horse_id", sire_col: str = "sire_id",
+                             dam_col: str = "dam_id", graph: PedigreeGraph = None) -> tuple:
+    """
+    Count offspring of parents that have half-sib progeny, i.e. more than one offspring by more than one mate.
+    Args:
+        pedigree: pedigree dataframe
+        id_col, sire_col, dam_col: names of the animal and parent id columns
+        graph: pedigree graph built from the pedigree, it is built here if not provided
+    Returns:
+        tuple: (maternal, paternal) tables with the parent id, n_offspring and n_mates;
+               an unknown mate counts as one distinct mate
+    """
+    graph = _get_graph(pedigree, id_col, sire_col, dam_col, graph)
+    sire, dam = graph.sire_idx, graph.dam_idx
+
+    def count(parent: np.ndarray, mate: np.ndarray, parent_col: str) -> pd.DataFrame:
+        known = parent >= 0
+        parent, mate = parent[known].astype(np.int64), mate[known].astype(np.int64)
+        n_offspring = np.bincount(parent, minlength=graph.n)
+        # distinct (parent, mate) pairs; -1 is shifted to 0 so an unknown mate is one key
+        pairs = np.unique(parent * (graph.n + 1) + (mate + 1))
+        n_mates = np.bincount(pairs // (graph.n + 1), minlength=graph.n)
+        selected = np.flatnonzero((n_offspring > 1) & (n_mates > 1))
+        return pd.DataFrame({parent_col: graph.id_of(selected),
+                             "n_offspring": n_offspring[selected],
+                             "n_mates": n_mates[selected]})
+
+    return count(dam, sire, "dam_id"), count(sire, dam, "sire_id")
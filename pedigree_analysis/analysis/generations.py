@@ -0,0 +1,87 @@
+"""This module contains generation depth, pedigree completeness and generation interval calculations"""
+
+import numpy as np
+import pandas as pd
+from preprocessing.pedigree_graph import PedigreeGraph
+
+
+def calc_generations(pedigree: pd.DataFrame, id_col: str = "horse_id", sire_col: str = "sire_id",
+                     dam_col: str = "dam_id", yob_col: str = "YOB", graph: PedigreeGraph = None) -> pd.DataFrame:
+    """
+    Compute pedigree depth and completeness of every animal.
+
+    The pedigree is ordered once by topological levels and the measures are propagated
+    generation by generation from founders to the youngest animals, all animals of a
+    level at once:
+        max_generations: number of generations to the most remote known ancestor
+        complete_generations: number of generations in which all ancestors are known
+        equivalent_generations: sum over known ancestors of (1/2)^g, g being the generation
+                                of the ancestor (1 for parents)
+    Args:
+        pedigree: cleaned pedigree
+        id_col, sire_col, dam_col: names of the animal and parent id columns
+        yob_col: name of the year of birth column
+        graph: pedigree graph built from pedigree with the same id columns, it is built here if not provided
+    Returns:
+        df: one row per animal with level, the three depth measures and the sire and dam
+            generation intervals (parent age in years at the birth of the animal);
+            animals in or below a pedigree loop get NaN
+    """
+    if graph is None:
+        graph = PedigreeGraph.from_frame(pedigree, id_col=id_col, sire_col=sire_col, dam_col=dam_col)
+
+    level = graph.topological_levels()
+    n = graph.n
+    max_gen = np.full(n, np.nan)
+    complete_gen = np.full(n, np.nan)
+    equiv_gen = np.full(n, np.nan)
+
+    s, d = graph.sire_idx, graph.dam_idx
+    has_s, has_d = s >= 0, d >= 0
+    for lev in range(int(level.max()) + 1 if n else 0):
+        members = np.flatnonzero(level == lev)
+        ms, md = s[members], d[members]
+        ks, kd = has_s[members], has_d[members]
+        # unknown parents contribute -1 generations, i.e. nothing beyond the animal itself
+        sire_max = np.where(ks, max_gen[np.where(ks, ms, 0)], -1)
+        dam_max = np.where(kd, max_gen[np.where(kd, md, 0)], -1)
+        max_gen[members] = np.maximum(sire_max, dam_max) + 1
+        complete_gen[members] = np.where(ks & kd, np.minimum(complete_gen[np.where(ks, ms, 0)],
+                                                             complete_gen[np.where(kd, md, 0)]) + 1, 0)
+        equiv_gen[members] = np.where(ks, 0.5 * (1 + equiv_gen[np.where(ks, ms, 0)]), 0) + \
+                             np.where(kd, 0.5 * (1 + equiv_gen[np.where(kd, md, 0)]), 0)
+
+    yob = pd.to_numeric(pd.Series(graph.node_values(pedigree[yob_col])), errors="coerce").to_numpy(dtype=float)
+    intervals = {}
+    for role, parent_idx, known in [("sire", s, has_s), ("dam", d, has_d)]:
+        parent_yob = np.full(n, np.nan)
+        parent_yob[known] = yob[parent_idx[known]]
+        intervals[f"{role}_interval"] = yob - parent_yob
+
+    return pd.DataFrame({"id": graph.ids, "YOB": yob, "level": np.where(level >= 0, level, np.nan),
+                         "max_generations": max_gen, "complete_generations": complete_gen,
+                         "equivalent_generations": equiv_gen, **intervals})
+
+
+def summarize_generations(generations: pd.DataFrame) -> pd.Series:
+    """
+    Summarize the per-animal table of calc_generations.
+    Args:
+        generations: table from calc_generations
+    Returns:
+        pd.Series: number of animals and levels, mean and maximum of the depth measures,
+                   mean generation intervals of sire-offspring, dam-offspring and all links,
+                   and the number of generations spanned by the years of birth
+    """
+    intervals = pd.concat([generations["sire_interval"], generations["dam_interval"]]).dropna()
+    mean_interval = intervals.mean()
+    yob_span = generations["YOB"].max() - generations["YOB"].min()
+    summary = {"n_animals": len(generations), "n_levels": generations["level"].max() + 1}
+    for col in ["max_generations", "complete_generations", "equivalent_generations"]:
+        summary[f"mean_{col}"] = generations[col].mean()
+        summary[f"max_{col}"] = generations[col].max()
+    summary.update({"sire_interval": generations["sire_interval"].mean(),
+                    "dam_interval": generations["dam_interval"].mean(),
+                    "generation_interval": mean_interval,
+                    "yob_span_generations": yob_span / mean_interval if mean_interval > 0 else np.nan})
+    return pd.Series(summary)
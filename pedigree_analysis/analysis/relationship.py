@@ -0,0 +1,151 @@
+"""This module contains functions computing inbreeding coefficients and the inverse numerator relationship matrix"""
+
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from preprocessing.pedigree_graph import PedigreeGraph, renumber
+
+
+def calc_inbreeding(sire: np.ndarray, dam: np.ndarray, level: np.ndarray,
+                    chunk_size: int = 1000) -> tuple:
+    """
+    Compute inbreeding coefficients from F_i = sum_j L_ij^2 D_j - 1 (Meuwissen & Luo, 1992),
+    where L_ij is the contribution of ancestor j to animal i.
+
+    This is not the ancestor-list recursion of Meuwissen & Luo: generations are processed in order
+    and the rows of L of all distinct parent pairs of a generation are traced together as sparse
+    products X @ P, one per generation back, so full sibs are traced once. The work is proportional
+    to the number of (ancestor, distance) paths of every parent pair and a chunk holds
+    chunk_size x (ancestors of the chunk) values instead of the n^2 of the relationship matrix.
+    Args:
+        sire: 1-based renumbered sires, 0 for unknown (see renumber)
+        dam: 1-based renumbered dams, 0 for unknown
+        level: generation level of every animal
+        chunk_size: number of parent pairs traced at once
+    Returns:
+        tuple: (F, D) arrays of length n with inbreeding coefficients and Mendelian sampling
+               variances (the diagonal of D in A = TDT')
+    """
+    n = len(sire)
+    s = np.asarray(sire, dtype=np.int64) - 1
+    d = np.asarray(dam, dtype=np.int64) - 1
+    F = np.zeros(n)
+    D = np.zeros(n)
+
+    # P[i, parent] = 0.5, one multiplication moves contributions one generation back
+    animal = np.arange(n)
+    P = sparse.csr_matrix(
+        (np.full(int((s >= 0).sum() + (d >= 0).sum()), 0.5),
+         (np.concatenate([animal[s >= 0], animal[d >= 0]]), np.concatenate([s[s >= 0], d[d >= 0]]))),
+        shape=(n, n))
+
+    for lev in range(int(level.max()) + 1 if n else 0):
+        members = np.flatnonzero(level == lev)
+        ms, md = s[members], d[members]
+        both = (ms >= 0) & (md >= 0)
+        if both.any():
+            pairs, pair_of = np.unique(np.stack([ms[both], md[both]], axis=1), axis=0, return_inverse=True)
+            pair_F = np.empty(len(pairs))
+            for start in range(0, len(pairs), chunk_size):
+                chunk = pairs[start:start + chunk_size]
+                rows = np.repeat(np.arange(len(chunk)), 2)
+                X = sparse.csr_matrix((np.full(len(rows), 0.5), (rows, chunk.ravel())), shape=(len(chunk), n))
+                # contributions of every generation back, summed once per ancestor on conversion
+                paths = []
+                while X.nnz:
+                    paths.append(X.tocoo())
+                    X = X @ P
+                L = sparse.csr_matrix((np.concatenate([x.data for x in paths]),
+                                       (np.concatenate([x.row for x in paths]), np.concatenate([x.col for x in paths]))),
+                                      shape=(len(chunk), n))
+                own_D = 0.5 - 0.25 * (F[chunk[:, 0]] + F[chunk[:, 1]])
+                pair_F[start:start + len(chunk)] = L.multiply(L) @ D + own_D - 1.0
+            F[members[both]] = pair_F[pair_of.ravel()]
+        # unknown parents count as F = -1
+        Fs = np.where(ms >= 0, F[np.where(ms >= 0, ms, 0)], -1.0)
+        Fd = np.where(md >= 0, F[np.where(md >= 0, md, 0)], -1.0)
+        D[members] = 0.5 - 0.25 * (Fs + Fd)
+
+    return F, D
+
+
+def calc_ainverse(sire: np.ndarray, dam: np.ndarray, D: np.ndarray) -> sparse.csr_matrix:
+    """
+    Build the inverse numerator relationship matrix with Henderson's rules accounting for inbreeding.
+    Args:
+        sire: 1-based renumbered sires, 0 for unknown
+        dam: 1-based renumbered dams, 0 for unknown
+        D: Mendelian sampling variances from calc_inbreeding
+    Returns:
+        sparse.csr_matrix: symmetric n x n A-inverse in renumbered order
+    """
+    n = len(sire)
+    animal = np.arange(n, dtype=np.int64)
+    s = np.asarray(sire, dtype=np.int64) - 1
+    d = np.asarray(dam, dtype=np.int64) - 1
+    b = 1.0 / np.asarray(D, dtype=np.float64)
+
+    rows, cols, vals = [animal], [animal], [b]
+    for p in (s, d):
+        known = p >= 0
+        # animal x parent and parent x animal
+        rows += [animal[known], p[known]]
+        cols += [p[known], animal[known]]
+        vals += [-0.5 * b[known], -0.5 * b[known]]
+    for p in (s, d):
+        for q in (s, d):
+            known = (p >= 0) & (q >= 0)
+            rows.append(p[known])
+            cols.append(q[known])
+            vals.append(0.25 * b[known])
+
+    # duplicated entries are summed on conversion to CSR
+    ainv = sparse.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(n, n)).tocsr()
+    ainv.sum_duplicates()
+    return ainv
+
+
+def ainverse_triplets(ainv: sparse.spmatrix) -> pd.DataFrame:
+    """Return the lower triangle of A-inverse as 1-based (row, col, value) triplets"""
+    lower = sparse.tril(ainv, format="coo")
+    return pd.DataFrame({"row": lower.row + 1, "col": lower.col + 1, "value": lower.data}) \
+        .sort_values(["row", "col"], ignore_index=True)
+
+
+def save_relationship(ped: pd.DataFrame, path: str, prefix: str = "pedigree", id_col: str = "horse_id",
+                      sire_col: str = "sire_id", dam_col: str = "dam_id") -> None:
+    """
+    Compute inbreeding and A-inverse for the cleaned pedigree and write them for BLUP software.
+
+    Files written to path:
+        {prefix}_inbreeding.csv: id, renumbered id, F
+        {prefix}_ainv.txt: lower triangle of A-inverse as "row col value", renumbered 1-based ids
+        {prefix}_inbreeding.npz: binary F, D and renumbered parents
+        {prefix}_ainv.npz: binary A-inverse in scipy CSR format
+    Args:
+        ped: cleaned pedigree dataframe
+        path: output directory
+        prefix: file name prefix
+        id_col, sire_col, dam_col: names of the animal and parent id columns
+    Raises:
+        FileNotFoundError: if the specified directory does not exist.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"The directory {path} does not exist.")
+
+    graph = PedigreeGraph.from_frame(ped, id_col=id_col, sire_col=sire_col, dam_col=dam_col)
+    order, sire, dam, level = renumber(graph)
+    F, D = calc_inbreeding(sire, dam, level)
+    ainv = calc_ainverse(sire, dam, D)
+
+    pd.DataFrame({"id": graph.id_of(order), "renum_id": np.arange(1, graph.n + 1), "F": F}) \
+        .to_csv(os.path.join(path, f"{prefix}_inbreeding.csv"), index=False)
+    ainverse_triplets(ainv) \
+        .to_csv(os.path.join(path, f"{prefix}_ainv.txt"), sep=" ", header=False, index=False,
+                float_format="%.10g")
+    np.savez(os.path.join(path, f"{prefix}_inbreeding.npz"), F=F, D=D, sire=sire, dam=dam)
+    sparse.save_npz(os.path.join(path, f"{prefix}_ainv.npz"), ainv)
+    print(f"Inbreeding and A-inverse for {graph.n} animals saved to {path}, "
+          f"{int((F > 0).sum())} animals are inbred, A-inverse has {ainv.nnz} non-zero elements")
@@ -0,0 +1,112 @@
+"""This module contains the extraction of ancestor/descendant sub-pedigrees of selected animals
+
+Usage (from the pedigree_analysis directory):
+    python -m analysis.subset --seed-file genotyped.txt --ancestors 3 --out results/sub_pedigree.csv
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+from preprocessing.pedigree_graph import PedigreeGraph, renumber
+
+
+def resolve_seeds(pedigree: pd.DataFrame, seeds, id_col: str = "horse_id", bed_col: str = "bed_id") -> np.ndarray:
+    """
+    Map seeds given as horse_id or bed_id to horse_id.
+    Args:
+        pedigree: cleaned pedigree
+        seeds: iterable of horse ids and/or bed ids
+        id_col, bed_col: names of the animal id and bed id columns
+    Returns:
+        np.ndarray: unique horse ids of the seeds found in the pedigree
+    """
+    seeds = pd.Index(pd.unique(pd.Series(list(seeds), dtype=object).astype(str)))
+    horse_ids = pedigree[id_col].dropna().astype(str)
+    by_bed = pedigree.dropna(subset=[id_col, bed_col])
+    bed_map = pd.Series(by_bed[id_col].astype(str).to_numpy(), index=by_bed[bed_col].astype(str).to_numpy())
+
+    found = pd.Index(horse_ids.unique()).intersection(seeds)
+    from_bed = bed_map[bed_map.index.isin(seeds)]
+    missing = seeds.difference(found).difference(from_bed.index)
+    if len(missing) > 0:
+        print(f"{len(missing)} seeds are not found in the pedigree")
+    return pd.unique(np.concatenate([found.to_numpy(dtype=object), from_bed.to_numpy(dtype=object)]))
+
+
+def extract_subpedigree(pedigree: pd.DataFrame, seeds, ancestors: int = None, descendants: int = 0,
+                        id_col: str = "horse_id", sire_col: str = "sire_id", dam_col: str = "dam_id",
+                        bed_col: str = "bed_id", graph: PedigreeGraph = None) -> pd.DataFrame:
+    """
+    Extract the seeds with their ancestors and/or descendants as a self-contained pedigree.
+
+    The selection is found by frontier-by-frontier traversal of the parent arrays and CSR
+    child lists, one vectorized step per generation. Parents outside the selection are set
+    to unknown and the records are renumbered so that parents come before offspring.
+    Args:
+        pedigree: cleaned pedigree
+        seeds: horse ids and/or bed ids of the animals of interest
+        ancestors: generations of ancestors to keep, all if None
+        descendants: generations of descendants to keep, all if None
+        id_col, sire_col, dam_col, bed_col: names of the id columns
+        graph: pedigree graph built from pedigree with the same id columns, it is built here if not provided
+    Returns:
+        df: records of the selected animals with the renumbered animal, sire and dam
+            (1-based, 0 for unknown) as the first columns, sorted by animal
+    """
+    pedigree = pedigree.copy()
+    for col in [id_col, sire_col, dam_col]:
+        pedigree[col] = pedigree[col].astype(object).where(pedigree[col].isna(), pedigree[col].astype(str))
+    if graph is None:
+        graph = PedigreeGraph.from_frame(pedigree, id_col=id_col, sire_col=sire_col, dam_col=dam_col)
+
+    seed_idx = graph.index_of(resolve_seeds(pedigree, seeds, id_col=id_col, bed_col=bed_col))
+    keep = np.zeros(graph.n, dtype=bool)
+    keep[seed_idx[seed_idx >= 0]] = True
+    if ancestors is None or ancestors > 0:
+        keep |= graph.ancestors(seed_idx, ancestors) >= 0
+    if descendants is None or descendants > 0:
+        keep |= graph.descendants(seed_idx, descendants) >= 0
+    nodes = np.flatnonzero(keep)
+
+    # parents referenced without a record of their own get an id-only record
+    rows = graph.row[nodes]
+    sub = pd.concat([pedigree.iloc[rows[rows >= 0]],
+                     pd.DataFrame({id_col: graph.id_of(nodes[rows < 0])})], ignore_index=True)
+    for col in [sire_col, dam_col]:
+        sub[col] = sub[col].where(sub[col].isin(sub[id_col]))
+
+    sub_graph = PedigreeGraph.from_frame(sub, id_col=id_col, sire_col=sire_col, dam_col=dam_col)
+    order, sire, dam, _ = renumber(sub_graph)
+    sub = sub.iloc[sub_graph.row[order]].reset_index(drop=True)
+    sub.insert(0, "dam", dam)
+    sub.insert(0, "sire", sire)
+    sub.insert(0, "animal", np.arange(1, len(order) + 1))
+    print(f"Sub-pedigree of {len(seed_idx[seed_idx >= 0])} seeds has {len(sub)} animals")
+    return sub
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Extract an ancestor/descendant sub-pedigree")
+    parser.add_argument("--pedigree", default="results/cleaned_pedigree.csv", help="cleaned pedigree csv")
+    parser.add_argument("--seeds", nargs="*", default=[], help="horse_id or bed_id of the seeds")
+    parser.add_argument("--seed-file", help="file with one horse_id or bed_id per line")
+    parser.add_argument("--ancestors", type=int, default=-1, help="generations of ancestors, -1 for all")
+    parser.add_argument("--descendants", type=int, default=0, help="generations of descendants, -1 for all")
+    parser.add_argument("--out", default="results/sub_pedigree.csv", help="output csv")
+    args = parser.parse_args()
+
+    seeds = list(args.seeds)
+    if args.seed_file:
+        with open(args.seed_file) as f:
+            seeds += [line.split()[0] for line in f if line.strip()]
+
+    pedigree = pd.read_csv(args.pedigree, dtype={"horse_id": str, "sire_id": str, "dam_id": str, "bed_id": str})
+    sub = extract_subpedigree(pedigree, seeds,
+                              ancestors=None if args.ancestors < 0 else args.ancestors,
+                              descendants=None if args.descendants < 0 else args.descendants)
+    sub.to_csv(args.out, index=False)
+    print(f"File saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
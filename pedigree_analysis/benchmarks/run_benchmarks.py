@@ -0,0 +1,159 @@
+"""This module contains the scaling benchmark of the preprocessing stages and analysis functions
+
+Usage (from the pedigree_analysis directory):
+    python -m benchmarks.run_benchmarks --sizes 10000 100000 1000000
+    python -m benchmarks.run_benchmarks --sizes 10000 100000 --baseline benchmarks/results/benchmark_20240301.csv
+
+Every size runs in its own process on synthetic inputs (see benchmarks.synthetic) with the
+caches pointed to the work directory, so the real cache, vocabulary and delta state are
+never touched and the peak memory of one size does not leak into the next.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from preprocessing.instrument import measure
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(PACKAGE_DIR, "benchmarks", "results")
+
+
+def _rows(outputs) -> int:
+    """Total number of rows of the dataframes among the outputs"""
+    values = outputs.values() if isinstance(outputs, dict) else outputs if isinstance(outputs, tuple) else [outputs]
+    return int(sum(len(v) for v in values if isinstance(v, (pd.DataFrame, pd.Series, np.ndarray))))
+
+
+def run_worker(work_dir: str, skip: list) -> list:
+    """Run every pipeline stage and analysis function on the inputs in work_dir; runs in a child process"""
+    os.chdir(work_dir)
+    import main
+    from analysis.family_structure import calc_trios, calc_siblings, calc_half_sibling_counts
+    from analysis.generations import calc_generations
+    from analysis.relationship import calc_inbreeding, calc_ainverse
+    from analysis.subset import extract_subpedigree
+    from preprocessing.export import write_parquet, write_arrow, write_renumbered
+    from preprocessing.pedigree_graph import PedigreeGraph, renumber
+    from preprocessing.validate import validate_pedigree
+
+    records, values = [], {}
+    for stage in main.build_pipeline().stages:
+        # stages downstream of a skipped stage are skipped as well
+        if stage.name in skip or any(name not in values for name in stage.inputs):
+            continue
+        outputs, record = measure(stage.func, **{name: values[name] for name in stage.inputs}, **stage.config,
+                                  **stage.options)
+        values.update(outputs)
+        records.append({"kind": "stage", "name": stage.name, "rows": _rows(outputs), **record})
+
+    final = values.get("final_pedigree")
+    if final is None:
+        return records
+    genotyped = final.loc[final["genotyped"].astype(bool), "bed_id"].to_numpy()
+    graph = PedigreeGraph.from_frame(final, id_col="horse_id")
+    ordered = {}
+    analyses = [
+        ("graph", lambda: PedigreeGraph.from_frame(final, id_col="horse_id")),
+        ("validate_pedigree", lambda: validate_pedigree(values["ped_cleaned"])),
+        ("calc_trios", lambda: calc_trios(final, graph=graph)),
+        ("calc_siblings", lambda: calc_siblings(final, graph=graph)),
+        ("calc_half_sibling_counts", lambda: calc_half_sibling_counts(final, graph=graph)),
+        ("calc_generations", lambda: calc_generations(final, graph=graph)),
+        ("renumber", lambda: ordered.update(zip(["order", "sire", "dam", "level"], renumber(graph))) or ordered["order"]),
+        ("calc_inbreeding", lambda: ordered.update(zip(["F", "D"], calc_inbreeding(
+            ordered["sire"], ordered["dam"], ordered["level"]))) or ordered["F"]),
+        ("calc_ainverse", lambda: calc_ainverse(ordered["sire"], ordered["dam"], ordered["D"]).diagonal()),
+        ("extract_subpedigree", lambda: extract_subpedigree(final, genotyped, ancestors=3)),
+        ("write_parquet", lambda: write_parquet(final, os.path.join("results", "bench.parquet"))),
+        ("write_arrow", lambda: write_arrow(final, os.path.join("results", "bench.arrow"))),
+        ("write_renumbered", lambda: write_renumbered(final, os.path.join("results", "bench"))),
+    ]
+    for name, func in analyses:
+        if name in skip:
+            continue
+        if name == "calc_ainverse" and "D" not in ordered:
+            continue
+        result, record = measure(func)
+        records.append({"kind": "analysis", "name": name, "rows": _rows(result), **record})
+    return records
+
+
+def run_size(n_animals: int, work_dir: str, seed: int, n_variants: int, skip: list) -> pd.DataFrame:
+    """Generate inputs of one size and benchmark them in a child process"""
+    from benchmarks.synthetic import generate, write_inputs
+
+    data, record = measure(generate, n_animals, seed=seed)
+    write_inputs(data, work_dir, n_variants=n_variants, seed=seed)
+    del data
+
+    env = {**os.environ, "PEDIGREE_CACHE_DIR": os.path.join(work_dir, "cache"),
+           "PYTHONPATH": os.pathsep.join([PACKAGE_DIR, os.environ.get("PYTHONPATH", "")])}
+    report = os.path.join(work_dir, "benchmark.json")
+    subprocess.run([sys.executable, "-m", "benchmarks.run_benchmarks", "--worker", work_dir, "--report", report,
+                    "--skip", *skip], env=env, cwd=PACKAGE_DIR, check=True)
+    with open(report) as f:
+        records = [{"kind": "input", "name": "generate", "rows": n_animals, **record}] + json.load(f)
+    return pd.DataFrame(records).assign(n_animals=n_animals)
+
+
+def compare(results: pd.DataFrame, baseline: pd.DataFrame, tolerance: float, min_seconds: float) -> pd.DataFrame:
+    """Return the measurements slower than tolerance x the baseline of the same name and size"""
+    merged = results.merge(baseline, on=["n_animals", "name"], suffixes=("", "_baseline"))
+    slower = (merged["wall_s"] > tolerance * merged["wall_s_baseline"]) & (merged["wall_s"] > min_seconds)
+    return merged.loc[slower, ["n_animals", "name", "wall_s_baseline", "wall_s", "peak_mb_baseline", "peak_mb"]]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic pedigrees of growing size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--n-variants", type=int, default=1000, help="SNPs of the denser array")
+    parser.add_argument("--skip", nargs="*", default=[], help="stages or analysis functions to skip")
+    parser.add_argument("--out", help="result csv, benchmarks/results/benchmark_<time>.csv by default")
+    parser.add_argument("--baseline", help="earlier result csv to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed slowdown against the baseline")
+    parser.add_argument("--keep", action="store_true", help="keep the generated inputs")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--report", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        with open(args.report, "w") as f:
+            json.dump(run_worker(args.worker, args.skip), f)
+        return
+
+    results = []
+    for n_animals in args.sizes:
+        work_dir = tempfile.mkdtemp(prefix=f"pedigree_bench_{n_animals}_")
+        print(f"----------Benchmarking {n_animals} animals in {work_dir}----------")
+        try:
+            results.append(run_size(n_animals, work_dir, args.seed, args.n_variants, args.skip))
+        finally:
+            if not args.keep:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    results = pd.concat(results, ignore_index=True)
+
+    out = args.out or os.path.join(RESULTS_DIR, f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.csv")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    results.to_csv(out, index=False)
+    table = results.pivot_table(index="name", columns="n_animals", values=["wall_s", "peak_mb"], sort=False)
+    print(table.round(2).to_string())
+    print(f"File saved to {out}")
+
+    if args.baseline:
+        slower = compare(results, pd.read_csv(args.baseline), args.tolerance, min_seconds=0.5)
+        if not slower.empty:
+            print(f"Regressions against {args.baseline}:\n{slower.round(2).to_string(index=False)}")
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""This module contains the generator of synthetic pedigree inputs in the schemas of the raw data
+
+Usage (from the pedigree_analysis directory):
+    python -m benchmarks.synthetic --n-animals 100000 --out /tmp/synthetic_1e5
+"""
+
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+from preprocessing.plink import BED_MAGIC
+from preprocessing.sources import PEDIGREE1_SHEETS, SOURCES_PATH
+
+SYLLABLES = np.array(["ka", "ro", "mi", "su", "de", "la", "no", "ve", "tor", "bel", "shan", "gri", "po", "lu",
+                      "zen", "mar", "qui", "da", "fen", "ho", "jas", "wyn", "tal", "bri", "cor", "nel", "pax",
+                      "vio", "ru", "sel", "tam", "or"])
+BATCHES = np.array(["20150101", "20180101", "20200101", "20220101"])
+CHIPS = np.array(["SNP50", "SNP70", "SNP70_V2", "SNP670"])
+COUNTRIES = np.array(["USA", "usa", "IRE", "Ireland", "GB", "great britain", "AUS", "australia", "FR", "NZ"])
+COLOURS = np.array(["b.", "ch.", "gr.", "br.", "bl.", "3"])
+# largest sheet openpyxl can write
+EXCEL_MAX_ROWS = 1048575
+
+
+def _names(rng: np.random.Generator, n: int) -> np.ndarray:
+    """Two-word horse names of three syllables each"""
+    parts = SYLLABLES[rng.integers(0, len(SYLLABLES), (n, 6))]
+    first = np.char.add(np.char.add(parts[:, 0], parts[:, 1]), parts[:, 2])
+    second = np.char.add(np.char.add(parts[:, 3], parts[:, 4]), parts[:, 5])
+    return np.char.add(np.char.add(first, " "), second).astype(object)
+
+
+def _pick_parent(rng: np.random.Generator, candidates: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """Pick a random candidate index in [lo, hi) of animal positions for every animal, -1 if there is none"""
+    start = np.searchsorted(candidates, lo)
+    stop = np.searchsorted(candidates, hi)
+    has = stop > start
+    pick = start + np.floor(rng.random(len(lo)) * np.maximum(stop - start, 1)).astype(np.int64)
+    return np.where(has, candidates[np.minimum(pick, len(candidates) - 1)], -1)
+
+
+def generate(n_animals: int, seed: int = 0, n_years: int = 100, genotyped_rate: float = 0.3,
+             dup_equinome_rate: float = 0.1, dup_horse_rate: float = 0.02, error_rate: float = 0.001,
+             founder_dup_rate: float = 0.01, n_addit: int = None) -> dict:
+    """
+    Generate a synthetic pedigree with genotype records.
+
+    Animals are born over n_years with parents picked among animals born 3 to 20 years earlier.
+    The data contain the issues the pipeline deals with: founders registered twice under a
+    misspelled name, several genotype records per equinomeID on mixed SNP chips, several
+    equinomeIDs per horse, bed ids missing from the .fam files, digits in colours and a
+    fraction error_rate of each logic error (sex conflicts, parents younger than offspring,
+    self-parenting, records with conflicting parents).
+    Args:
+        n_animals: number of animals of PedNew
+        seed: random seed
+        n_years: number of birth years
+        genotyped_rate: share of animals of the last 30 years that are genotyped
+        dup_equinome_rate: share of equinomeIDs with a second genotype record
+        dup_horse_rate: share of genotyped horses with a second equinomeID
+        error_rate: share of animals with each injected logic error
+        founder_dup_rate: share of animals born before 1960 registered twice
+        n_addit: number of Pedigree #2 records, n_animals // 10 if None
+    Returns:
+        dict: PedNew, PedIDMatch, GenotypeIDs, ped_addit (Pedigree #2) and fam (bed ids per array)
+    """
+    rng = np.random.default_rng(seed)
+    n = n_animals
+    pos = np.arange(n)
+    per_year = max(n / n_years, 1)
+    yob = (2020 - n_years + pos // per_year).astype(np.int64)
+    sex = rng.integers(1, 3, n)
+    names = _names(rng, n)
+
+    males, females = np.flatnonzero(sex == 1), np.flatnonzero(sex == 2)
+    lo = (pos - 20 * per_year).astype(np.int64)
+    hi = (pos - 3 * per_year).astype(np.int64)
+    sire = _pick_parent(rng, males, lo, hi)
+    dam = _pick_parent(rng, females, lo, hi)
+    sire[rng.random(n) < 0.05] = -1
+    dam[rng.random(n) < 0.05] = -1
+
+    # injected logic errors
+    n_err = max(int(n * error_rate), 1)
+    has_sire = np.flatnonzero(sire >= 0)
+    younger = rng.choice(has_sire, n_err)
+    sire[younger] = np.minimum(younger + int(5 * per_year), n - 1)
+    sex[rng.choice(sire[has_sire], n_err)] = 2
+    sire[rng.choice(males, n_err)] = rng.choice(males, n_err)
+    selfish = rng.choice(males, n_err)
+    sire[selfish] = selfish
+
+    ids = (pos + 1).astype(str).astype(object)
+
+    def parent_ids(idx: np.ndarray) -> np.ndarray:
+        out = np.where(idx >= 0, (idx + 1).astype(str), "").astype(object)
+        out[idx < 0] = np.nan
+        return out
+
+    colour = COLOURS[rng.integers(0, len(COLOURS), n)]
+    ped = pd.DataFrame({"id": ids, "status": "1", "name": names, "sire_id": parent_ids(sire),
+                        "dam_id": parent_ids(dam), "YOB": yob.astype(str), "sex": sex.astype(str),
+                        "colour": colour, "COB": COUNTRIES[rng.integers(0, len(COUNTRIES), n)]})
+
+    # old founders registered again under a new id and a misspelled name
+    old = np.flatnonzero(yob < 1960)
+    dups = rng.choice(old, min(int(n * founder_dup_rate), len(old)), replace=False)
+    dup_rows = ped.iloc[dups].assign(id=(n + 1 + np.arange(len(dups))).astype(str),
+                                     name=ped["name"].iloc[dups].str.replace(" ", "", regex=False),
+                                     sire_id=np.nan, dam_id=np.nan)
+    # records of the same id with a conflicting sire
+    conflicts = ped.iloc[rng.choice(has_sire, n_err)].assign(sire_id=parent_ids(rng.choice(males, n_err)))
+    ped = pd.concat([ped, dup_rows, conflicts], ignore_index=True)
+
+    # genotyped horses, their equinomeIDs and genotype records
+    recent = np.flatnonzero(yob >= 1990)
+    genotyped = np.sort(rng.choice(recent, int(len(recent) * genotyped_rate), replace=False))
+    equinome = np.char.add("EQ", (genotyped + 1).astype(str)).astype(object)
+    horse = genotyped
+    second = rng.choice(len(genotyped), int(len(genotyped) * dup_horse_rate), replace=False)
+    equinome = np.concatenate([equinome, np.char.add("EQB", (genotyped[second] + 1).astype(str)).astype(object)])
+    horse = np.concatenate([horse, genotyped[second]])
+    pedid_match = pd.DataFrame({"Equinome ID": equinome, "Horse Name": names[horse],
+                                "horse_id": (horse + 1).astype(str).astype(object)})
+
+    geno_id = _genotype_records(rng, equinome, yob[horse], sex[horse], dup_equinome_rate)
+
+    ped_addit = _pedigree2(rng, n_addit if n_addit is not None else max(n // 10, 1), names, sex, yob,
+                           dup_equinome_rate)
+
+    bed_ids = np.concatenate([geno_id["id"].to_numpy(), ped_addit["id"].to_numpy()])
+    dense = np.concatenate([geno_id["SNPChip"].to_numpy(), ped_addit["SNPChip"].to_numpy()]) == "SNP670"
+    on_fam = rng.random(len(bed_ids)) >= 0.01
+    fam = {"TB_11K": bed_ids[on_fam & dense], "TB_6K": bed_ids[on_fam & ~dense]}
+    return {"PedNew": ped, "PedIDMatch": pedid_match, "GenotypeIDs": geno_id, "ped_addit": ped_addit, "fam": fam}
+
+
+def _genotype_records(rng: np.random.Generator, equinome: np.ndarray, yob: np.ndarray, sex: np.ndarray,
+                      dup_rate: float) -> pd.DataFrame:
+    """GenotypeIDs records, dup_rate of the equinomeIDs get a second record of another batch and chip"""
+    batch = rng.integers(0, len(BATCHES), len(equinome))
+    extra = rng.choice(len(equinome), int(len(equinome) * dup_rate), replace=False)
+    rec = np.concatenate([np.arange(len(equinome)), extra])
+    batch = np.concatenate([batch, (batch[extra] + 1) % len(BATCHES)])
+    chips = CHIPS[rng.integers(0, len(CHIPS), len(rec))]
+    return pd.DataFrame({"id": np.char.add(np.char.add(BATCHES[batch], "_"), equinome[rec].astype(str)).astype(object),
+                         "batchID": BATCHES[batch], "equinomeID": equinome[rec], "SNPChip": chips,
+                         "Year of Birth": yob[rec].astype(str),
+                         "sex": np.where(sex[rec] == 1, "Male", "Female"),
+                         "Country Reported": COUNTRIES[rng.integers(0, len(COUNTRIES), len(rec))]})
+
+
+def _pedigree2(rng: np.random.Generator, m: int, names: np.ndarray, sex: np.ndarray, yob: np.ndarray,
+               dup_rate: float) -> pd.DataFrame:
+    """Pedigree #2 records of young animals whose parents are given by name, some of them misspelled"""
+    candidates = np.flatnonzero((yob >= 2000) & (yob <= 2017))
+    candidates = candidates if len(candidates) else np.arange(len(names))
+    sires = rng.choice(candidates[sex[candidates] == 1], m) if (sex[candidates] == 1).any() else np.zeros(m, int)
+    dams = rng.choice(candidates[sex[candidates] == 2], m) if (sex[candidates] == 2).any() else np.zeros(m, int)
+    sire_names = pd.Series(names[sires])
+    typo = rng.random(m) < 0.1
+    sire_names[typo] = sire_names[typo].str.replace(" ", "", regex=False)
+
+    n_eq = max(int(m * (1 - dup_rate)), 1)
+    equinome = np.char.add("N", (np.arange(m) % n_eq).astype(str))
+    chips = CHIPS[rng.integers(0, len(CHIPS), m)]
+    return pd.DataFrame({"id": np.char.add("20230101_N", np.arange(m).astype(str)).astype(object),
+                         "batchID": "20230101", "equinomeID": equinome.astype(object), "SNPChip": chips,
+                         "Year of Birth": "2020", "sex": np.where(rng.random(m) < 0.5, "Male", "Female"),
+                         "Country Reported": COUNTRIES[rng.integers(0, len(COUNTRIES), m)],
+                         "Horse Name": _names(rng, m), "Sire": sire_names.to_numpy(), "Dam": names[dams],
+                         "Month of Birth": "May", "Country of Birth": COUNTRIES[rng.integers(0, len(COUNTRIES), m)]})
+
+
+def write_bed(prefix: str, bed_ids: np.ndarray, n_variants: int, rng: np.random.Generator,
+              variant_step: int = 1) -> None:
+    """Write a PLINK .bed/.bim/.fam with random genotypes; every variant_step-th SNP of the panel is on the array"""
+    snps = np.arange(0, n_variants * variant_step, variant_step)
+    pd.DataFrame({"fid": bed_ids, "iid": bed_ids, "father": 0, "mother": 0, "sex": 0, "phenotype": -9}) \
+      .to_csv(f"{prefix}.fam", sep=" ", header=False, index=False)
+    pd.DataFrame({"chrom": 1, "snp": np.char.add("rs", snps.astype(str)), "cm": 0, "pos": snps + 1,
+                  "a1": "A", "a2": "G"}).to_csv(f"{prefix}.bim", sep="\t", header=False, index=False)
+    bytes_per_variant = (len(bed_ids) + 3) // 4
+    with open(f"{prefix}.bed", "wb") as f:
+        f.write(BED_MAGIC)
+        for start in range(0, len(snps), 1000):
+            block = rng.integers(0, 256, (min(1000, len(snps) - start), bytes_per_variant), dtype=np.uint8)
+            f.write(block.tobytes())
+
+
+def write_inputs(data: dict, out_dir: str, n_variants: int = 1000, excel: bool = None, seed: int = 0) -> None:
+    """
+    Write generated data in the layout main.py reads: data/raw_pedigree_part1.xlsx,
+    data/raw_pedigree_part2.csv, geno/TB_11K and geno/TB_6K PLINK files and the
+    sources.json registry listing them. Sheets too large for Excel (or all sheets if
+    excel is False) are written as data/raw_pedigree_part1/{sheet}.csv instead.
+    """
+    rng = np.random.default_rng(seed)
+    for sub in ["data", "geno", "results"]:
+        os.makedirs(os.path.join(out_dir, sub), exist_ok=True)
+    sheets = list(PEDIGREE1_SHEETS.values())
+    if excel is None:
+        excel = max(len(data[sheet]) for sheet in sheets) <= EXCEL_MAX_ROWS
+    if excel:
+        pedigree1 = {"name": "raw_pedigree_part1", "path": "data/raw_pedigree_part1.xlsx"}
+        with pd.ExcelWriter(os.path.join(out_dir, pedigree1["path"])) as writer:
+            for sheet in sheets:
+                data[sheet].to_excel(writer, sheet_name=sheet, index=False)
+    else:
+        files = {table: f"data/raw_pedigree_part1/{sheet}.csv" for table, sheet in PEDIGREE1_SHEETS.items()}
+        pedigree1 = {"name": "raw_pedigree_part1", "files": files}
+        os.makedirs(os.path.join(out_dir, "data", "raw_pedigree_part1"), exist_ok=True)
+        for table, sheet in PEDIGREE1_SHEETS.items():
+            data[sheet].to_csv(os.path.join(out_dir, pedigree1["files"][table]), index=False)
+    data["ped_addit"].to_csv(os.path.join(out_dir, "data", "raw_pedigree_part2.csv"), index=False)
+    write_bed(os.path.join(out_dir, "geno", "TB_11K"), data["fam"]["TB_11K"], n_variants, rng)
+    write_bed(os.path.join(out_dir, "geno", "TB_6K"), data["fam"]["TB_6K"], n_variants // 2, rng, variant_step=2)
+    registry = {"pedigree1": [pedigree1],
+                "pedigree2": [{"name": "raw_pedigree_part2", "path": "data/raw_pedigree_part2.csv"}],
+                "arrays": [{"name": name, "prefix": f"geno/{name}"} for name in ["TB_11K", "TB_6K"]]}
+    with open(os.path.join(out_dir, SOURCES_PATH), "w") as f:
+        json.dump(registry, f, indent=2)
+    print(f"Synthetic inputs of {len(data['PedNew'])} PedNew records saved to {out_dir}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate synthetic pedigree inputs")
+    parser.add_argument("--n-animals", type=int, default=10000)
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--n-variants", type=int, default=1000, help="SNPs of the denser array")
+    parser.add_argument("--csv", action="store_true", help="write Pedigree #1 sheets as csv instead of xlsx")
+    args = parser.parse_args()
+    write_inputs(generate(args.n_animals, seed=args.seed), args.out, n_variants=args.n_variants,
+                 excel=False if args.csv else None, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
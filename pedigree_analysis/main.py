@@ -1,13 +1,25 @@
+import argparse
 import os
+import time
 import pandas as pd
-from preprocessing.load_data import read_pedigree_sheets, get_pedigree_csv, read_fam
-from preprocessing.filter_geno import filter_by_fam, filter_by_chip, update_idmatch
+from preprocessing.sources import SOURCES_PATH, load_registry, load_sources, source_hashes
+from preprocessing.filter_geno import update_idmatch
+from preprocessing.genotype_dedup import DEFAULT_RULES, select_genotypes, excluded_bed_ids
 from preprocessing.clean_data import clear_colour, fix_logic
-from preprocessing.match_n_merge import merge_1stdataframes, clear_ped_additional, modifying_countries, concat_peds
+from preprocessing.validate import validate_pedigree
+from preprocessing.match_n_merge import merge_1stdataframes, clear_ped_additional, modifying_countries, \
+    normalize_descriptors, concat_peds
 from preprocessing.utils import save_file, clear_string_val
+from preprocessing.cache import clear_cache, file_hash
+from preprocessing.pipeline import Pipeline, Stage
+from preprocessing.instrument import RunReport
+from preprocessing.mendel_check import check_mendel
+from preprocessing.founder_dedup import find_founder_duplicates, merge_founders
+from preprocessing.name_index import get_name_index, resolve_parent_names
+from preprocessing.incremental import save_state, save_delta, load_state, apply_batch, write_delta
+from preprocessing.export import write_renumbered
 
 
-geno_path = "/home/kseniia/projects/data/raw_data/"
 results_path = "/home/kseniia/projects/github/pedigree_analysis/results"
 
 country_unific_dict = {"australia": "AUS",
@@ -54,52 +66,48 @@ col_order = ["horse_id", "status", "horse_name", "sire_id",
          "equinome_id", "bed_id", "batch", "snp_chip", 
          "country_reported", "genotyped"]
 
-if os.path.exists(os.path.join(results_path, "bedids2exclude.txt")):
-    os.remove(os.path.join(results_path, "bedids2exclude.txt"))
-    print("bedid2exclude has been removed")
+# stage functions receive their inputs and config as keyword arguments and return a dict of outputs;
+# sha256 arguments are only there to make input file changes part of the stage fingerprint
+def load_inputs(registry: dict, sha256: dict, use_cache: bool = True) -> dict:
+    # pedigree sheets/csv files and plink fam files of the registry, loaded concurrently into one schema
+    return load_sources(registry, use_cache=use_cache)
 
-def main() -> None:
 
-    # initializing a list to hold removed bed_ids
-    removed_bedids = []
-
-    ### Step 1: Load all data
-    # 1st part of pedigree
-    pedid_match, ped_df, geno_id = read_pedigree_sheets(
-        os.path.join("data/raw_pedigree_part1.xlsx")
-        )
-    # 2nd part of pedigree
-    ped_addit = get_pedigree_csv(
-        os.path.join("data/raw_pedigree_part2.csv")
-        )
-    # plink fam files
-    fam_11k_ids = read_fam(os.path.join(geno_path, "TB_11K.fam"))
-    fam_6k_ids = read_fam(os.path.join(geno_path, "TB_6K.fam"))
-    bed_ids = fam_11k_ids.union(fam_6k_ids)
-
-    # umbigous individuals
-    # sameid_diff_names = pd.read_csv("problems/pedid_dup_diff_names.csv")["Equinome ID"]
-    # Already removed from raw_dataset after review
+def dedup_founders(ped_df: pd.DataFrame, pedid_match: pd.DataFrame, max_yob: int, yob_window: int,
+                   min_score: float, country_unific_dict: dict) -> dict:
+    # old founders registered several times under different ids (README issue 2)
+    founder_merge_map = find_founder_duplicates(ped_df, max_yob=max_yob, yob_window=yob_window,
+                                                min_score=min_score, country_unific_dict=country_unific_dict)
+    ped_dedup, pedid_match_dedup = merge_founders(ped_df, pedid_match, founder_merge_map)
+    return {"ped_dedup": ped_dedup, "pedid_match_dedup": pedid_match_dedup,
+            "founder_merge_map": founder_merge_map}
+
 
+def clean_pedigree1(ped_dedup: pd.DataFrame, min_interval: int, max_interval: int) -> dict:
     ### Step 2: Clean 1st pedigree DataFrame
-    ped_cleaned = fix_logic(clear_colour(init_file=ped_df, col_name="colour"))
+    ped_colour = clear_colour(init_file=ped_dedup.copy(), col_name="colour")
+    pedigree_violations = validate_pedigree(ped_colour, min_interval=min_interval, max_interval=max_interval)
+    ped_cleaned = fix_logic(ped_colour, violations=pedigree_violations)
     print("----------Cleaning of 1st pedigree has finished----------")
+    return {"ped_cleaned": ped_cleaned, "pedigree_violations": pedigree_violations}
 
+
+def filter_genotypes(geno_id: pd.DataFrame, ped_addit: pd.DataFrame, bed_ids: pd.Index, rules: list) -> dict:
     ### Step 3: Clean genotype information and remove duplicates based on SNPchip
-    geno_id_chip_filtered = filter_by_chip(
-        filter_by_fam(geno_id, "id", bed_ids), 
-        snp_col="SNPChip", batch_col="batchID", equinomeid="equinomeID", bedid="id", 
-        removed_bedids=removed_bedids)
-    print("----------Filtering on presence in fam and prioritizing on chip info of genotypes has finished; geno_id has updated for 1st pedigree----------")
-
-    ped_addit_chip_filtered = filter_by_chip(
-        filter_by_fam(ped_addit, "id", bed_ids), 
-        snp_col="SNPChip", batch_col="batchID", equinomeid="equinomeID", bedid="id", 
-        removed_bedids=removed_bedids)
-    print("----------Filtering on presence in fam and prioritizing on chip info of genotypes has finished; geno_id has updated for 2nd pedigree----------")
+    # both pedigrees are filtered on presence in fam and prioritized on chip info in one pass
+    kept, chip_exclusions = select_genotypes({"geno_id": geno_id, "ped_addit": ped_addit}, key="equinomeID",
+                                             rules=rules, bed_col="id", fam_ids=bed_ids,
+                                             reason="duplicate_equinome_id")
+    print("----------Filtering on presence in fam and prioritizing on chip info of genotypes has finished----------")
+
+    return {"geno_id_chip_filtered": kept["geno_id"],
+            "ped_addit_chip_filtered": kept["ped_addit"],
+            "chip_exclusions": chip_exclusions}
 
+
+def dedup_horse_ids(pedid_match_dedup: pd.DataFrame, geno_id_chip_filtered: pd.DataFrame, rules: list) -> dict:
     # Step 4: Update pedid_match with the cleaned geno_id
-    pedid_match_chip_filtered = update_idmatch(pedid_match=pedid_match, 
+    pedid_match_chip_filtered = update_idmatch(pedid_match=pedid_match_dedup, 
                                                new_geno=geno_id_chip_filtered)
     print("----------pedid_match has updated: no extra SNPchips----------")
 
@@ -122,8 +130,9 @@ def main() -> None:
                                             right_on="equinomeID", how="left")
     
     # filtering those equinome id by chip priority
-    no_eqdup = filter_by_chip(dup_merged, "SNPChip", "batchID", "horse_id", "id", removed_bedids)
-    removed_ids = dup_merged[~dup_merged["Equinome ID"].isin(no_eqdup["Equinome ID"])]["Equinome ID"].tolist()
+    kept, horse_exclusions = select_genotypes({"pedid_match": dup_merged}, key="horse_id", rules=rules,
+                                              bed_col="id", reason="duplicate_horse_id")
+    removed_ids = dup_merged[~dup_merged["Equinome ID"].isin(kept["pedid_match"]["Equinome ID"])]["Equinome ID"].tolist()
     
     # update new_geno
     geno_id_nodup = geno_id_chip_filtered[~geno_id_chip_filtered["equinomeID"].isin(removed_ids)]
@@ -132,26 +141,151 @@ def main() -> None:
     # update pedid_match
     pedid_match_nodup = update_idmatch(pedid_match=pedid_match_chip_filtered, new_geno=geno_id_nodup)
     print("----------pedid_match has updated: no extra equinomeID per horse----------")
+    return {"geno_id_nodup": geno_id_nodup, "pedid_match_nodup": pedid_match_nodup,
+            "horse_exclusions": horse_exclusions}
+
 
+def prepare_pedigrees(ped_cleaned: pd.DataFrame, pedid_match_nodup: pd.DataFrame, geno_id_nodup: pd.DataFrame,
+                      ped_addit_chip_filtered: pd.DataFrame, country_unific_dict: dict) -> dict:
     # Step 6: Modifying columns and prepare pedigres
     ped_1stmerged = merge_1stdataframes(ped_df=ped_cleaned, 
                                          pedid_match=pedid_match_nodup, 
                                          geno_id=geno_id_nodup)
-    ped_addit_prep = clear_ped_additional(ped_addit_chip_filtered)
+    # sire and dam names of the 2nd pedigree are resolved to horse_id of the 1st one
+    parent_ids, ambiguous_parents = resolve_parent_names(ped_addit_chip_filtered, get_name_index(ped_cleaned))
+    ped_addit_prep = clear_ped_additional(ped_addit_chip_filtered, parent_ids)
     
     ped_1stmerged, ped_addit_prep = modifying_countries(ped_1stmerged, ped_addit_prep,
                                        country_unific_dict)
-    
+    ped_1stmerged, ped_addit_prep = normalize_descriptors(ped_1stmerged, ped_addit_prep)
+    return {"ped_1stmerged": ped_1stmerged, "ped_addit_prep": ped_addit_prep,
+            "ambiguous_parents": ambiguous_parents}
+
+
+def concat_pedigrees(ped_1stmerged: pd.DataFrame, ped_addit_prep: pd.DataFrame, col_order: list) -> dict:
     # Step 7: Concatenating 2 datasets
-    final_pedigree = concat_peds(ped_1stmerged, ped_addit_prep, col_order)
-  
+    return {"final_pedigree": concat_peds(ped_1stmerged, ped_addit_prep, col_order)}
+
+
+def check_trios(final_pedigree: pd.DataFrame, bed_prefixes: list, sha256: list, max_error_rate: float) -> dict:
+    # Mendelian errors of genotyped trios (README issue 4)
+    return {"mendel_errors": check_mendel(final_pedigree, bed_prefixes, max_error_rate=max_error_rate)}
+
+
+def save_results(final_pedigree: pd.DataFrame, chip_exclusions: pd.DataFrame, horse_exclusions: pd.DataFrame,
+                 mendel_errors: pd.DataFrame, founder_merge_map: pd.DataFrame,
+                 ambiguous_parents: pd.DataFrame, pedigree_violations: pd.DataFrame) -> dict:
     # saving results
     save_file(final_pedigree, "results/", "cleaned_pedigree.csv")
+    save_file(final_pedigree, "results/", "cleaned_pedigree.parquet")
+    save_file(final_pedigree, "results/", "cleaned_pedigree.arrow")
+    write_renumbered(final_pedigree, "results/cleaned_pedigree")
+    save_file(mendel_errors, "results/", "mendel_errors.csv")
+    save_file(founder_merge_map, "results/", "founder_merge_map.csv")
+    save_file(ambiguous_parents, "results/", "ambiguous_parents.csv")
+    save_file(pedigree_violations, "results/", "pedigree_violations.csv")
+
+    genotype_exclusions = pd.concat([chip_exclusions, horse_exclusions], ignore_index=True)
+    save_file(genotype_exclusions, "results/", "genotype_exclusions.csv")
 
     # Write all removed bedids to a file
     with open("results/bedids2exclude.txt", 'w') as f:
-        for bedid in removed_bedids:
+        for bedid in excluded_bed_ids(genotype_exclusions):
             f.write(f"{bedid} {bedid}\n")
 
+    # starting point of later --delta runs
+    save_state(final_pedigree, genotype_exclusions)
+    return {}
+
+
+def run_delta(batch_path: str, fam_paths: list) -> None:
+    """Add a new genotyping batch to the results of the last full run"""
+    registry = {"pedigree2": [{"name": "batch", "path": batch_path}],
+                "arrays": [{"name": path, "prefix": os.path.splitext(path)[0]} for path in fam_paths]}
+    batch = load_sources(registry, use_cache=False)
+    state, diff = apply_batch(load_state(), batch["ped_addit"], batch["bed_ids"], DEFAULT_RULES,
+                              country_unific_dict, col_order)
+    write_delta(state, diff, "results/")
+    save_delta(diff)
+
+
+def build_pipeline(sources_path: str = SOURCES_PATH, hash_inputs: bool = True, use_cache: bool = True) -> Pipeline:
+    """
+    Declare the preprocessing stages, their inputs, outputs and config.
+    hash_inputs=False leaves out the input file hashes, for listing the stages without reading every input;
+    use_cache=False parses the inputs without the parsed file cache
+    """
+    registry = load_registry(sources_path)
+    bed_prefixes = [source["prefix"] for source in registry.get("arrays", [])]
+    source_sha256 = source_hashes(registry) if hash_inputs else None
+    bed_sha256 = [file_hash(f"{prefix}.bed") for prefix in bed_prefixes] if hash_inputs else None
+
+    ### Step 1: Load all data; file hashes are part of the config so changed inputs rerun the stage
+    return Pipeline([
+        Stage("load_inputs", load_inputs, [], ["pedid_match", "ped_df", "geno_id", "ped_addit", "bed_ids"],
+              config={"registry": registry, "sha256": source_sha256}, options={"use_cache": use_cache}),
+        Stage("dedup_founders", dedup_founders, ["ped_df", "pedid_match"],
+              ["ped_dedup", "pedid_match_dedup", "founder_merge_map"],
+              config={"max_yob": 1960, "yob_window": 1, "min_score": 0.9,
+                      "country_unific_dict": country_unific_dict}),
+        Stage("clean_pedigree1", clean_pedigree1, ["ped_dedup"], ["ped_cleaned", "pedigree_violations"],
+              config={"min_interval": 2, "max_interval": 30}),
+        Stage("filter_genotypes", filter_genotypes, ["geno_id", "ped_addit", "bed_ids"],
+              ["geno_id_chip_filtered", "ped_addit_chip_filtered", "chip_exclusions"],
+              config={"rules": DEFAULT_RULES}),
+        Stage("dedup_horse_ids", dedup_horse_ids, ["pedid_match_dedup", "geno_id_chip_filtered"],
+              ["geno_id_nodup", "pedid_match_nodup", "horse_exclusions"],
+              config={"rules": DEFAULT_RULES}),
+        Stage("prepare_pedigrees", prepare_pedigrees,
+              ["ped_cleaned", "pedid_match_nodup", "geno_id_nodup", "ped_addit_chip_filtered"],
+              ["ped_1stmerged", "ped_addit_prep", "ambiguous_parents"],
+              config={"country_unific_dict": country_unific_dict}),
+        Stage("concat_pedigrees", concat_pedigrees, ["ped_1stmerged", "ped_addit_prep"], ["final_pedigree"],
+              config={"col_order": col_order}),
+        Stage("check_trios", check_trios, ["final_pedigree"], ["mendel_errors"],
+              config={"bed_prefixes": bed_prefixes, "sha256": bed_sha256, "max_error_rate": 0.02}),
+        Stage("save_results", save_results,
+              ["final_pedigree", "chip_exclusions", "horse_exclusions", "mendel_errors", "founder_merge_map",
+               "ambiguous_parents", "pedigree_violations"], [],
+              persist=False),
+    ])
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="Pedigree preprocessing pipeline")
+    parser.add_argument("--stage", help="run only this stage, upstream outputs are loaded from the store")
+    parser.add_argument("--from", dest="start", help="first stage to run")
+    parser.add_argument("--to", dest="stop", help="last stage to run")
+    parser.add_argument("--force", action="store_true", help="recompute the selected stages even if they are up to date")
+    parser.add_argument("--list", action="store_true", help="list the stages and exit")
+    parser.add_argument("--sources", default=SOURCES_PATH, help="source registry, see preprocessing/sources.py")
+    parser.add_argument("--delta", metavar="BATCH_CSV", help="add a new genotyping batch to the last run's results")
+    parser.add_argument("--fam", nargs="+", default=[], help=".fam files with the bed ids of the new batch, required with --delta")
+    parser.add_argument("--no-cache", action="store_true", help="parse the inputs without the parsed file cache")
+    parser.add_argument("--clear-cache", action="store_true", help="empty the parsed file cache before running")
+    parser.add_argument("--profile", nargs="*", metavar="NAME",
+                        help="run the named stages or functions under cProfile, every stage if no name is given")
+    parser.add_argument("--trace-memory", action="store_true", help="trace Python allocations with tracemalloc")
+    args = parser.parse_args()
+    if args.delta and not args.fam:
+        parser.error("--delta needs --fam with the .fam files of the batch")
+
+    if args.list:
+        print("\n".join(build_pipeline(args.sources, hash_inputs=False).names()))
+        return
+    if args.clear_cache:
+        clear_cache()
+    pipeline = None if args.delta else build_pipeline(args.sources, use_cache=not args.no_cache)
+
+    # every run leaves a JSON report with timings, memory and row counts of its stages
+    with RunReport(profile=args.profile, trace_memory=args.trace_memory) as report:
+        if args.delta:
+            report.call("stage", "delta", run_delta, (args.delta, args.fam), {})
+        else:
+            start, stop = (args.stage, args.stage) if args.stage else (args.start, args.stop)
+            pipeline.run(start=start, stop=stop, force=args.force, report=report)
+    report.save(os.path.join("results", f"run_report_{time.strftime('%Y%m%d_%H%M%S')}.json"))
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
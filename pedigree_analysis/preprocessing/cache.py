@@ -0,0 +1,155 @@
+"""This module contains a content-hashed cache of parsed raw input files"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Callable, Dict, Union
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# PEDIGREE_CACHE_DIR points all caches and persisted state elsewhere, e.g. for benchmark runs
+CACHE_DIR = os.environ.get("PEDIGREE_CACHE_DIR",
+                           os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache"))
+MAX_CACHE_BYTES = 2 * 1024 ** 3
+_HASH_DIR = "hashes"
+
+
+def file_hash(name: str, cache_dir: str = CACHE_DIR) -> str:
+    """
+    Return the sha256 of a file's content.
+    The hash is remembered together with the file size and modification time,
+    so an unchanged file is not read again on the next run.
+    Args:
+        name: path to the file
+        cache_dir: directory holding the hash entries
+    Returns:
+        str: hex digest of the file content
+    """
+    stat = os.stat(name)
+    signature = [stat.st_size, stat.st_mtime_ns]
+    path = os.path.abspath(name)
+    # one entry file per source file: processes hashing different files never rewrite each
+    # other's entries, so no update is lost, and the atomic replace prevents torn reads
+    entry_path = os.path.join(cache_dir, _HASH_DIR, f"{hashlib.sha256(path.encode()).hexdigest()[:32]}.json")
+    if os.path.exists(entry_path):
+        with open(entry_path) as f:
+            entry = json.load(f)
+        if entry["path"] == path and entry["signature"] == signature:
+            return entry["sha256"]
+
+    digest = hashlib.sha256()
+    with open(name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+    with open(f"{entry_path}.tmp{os.getpid()}", "w") as f:
+        json.dump({"path": path, "signature": signature, "sha256": digest.hexdigest()}, f)
+    os.replace(f"{entry_path}.tmp{os.getpid()}", entry_path)
+    return digest.hexdigest()
+
+
+def cached_read(name: str, reader: Callable[[], Union[pd.DataFrame, Dict[str, pd.DataFrame]]],
+                options: dict, cache_dir: str = CACHE_DIR, use_cache: bool = True,
+                max_bytes: int = MAX_CACHE_BYTES) -> Union[pd.DataFrame, Dict[str, pd.DataFrame]]:
+    """
+    Return the parsed content of a file from the cache or parse it with reader and store it.
+
+    Entries are keyed by the file content hash and the reader options and stored as
+    uncompressed Arrow IPC files, which are loaded through a memory map.
+    Args:
+        name: path to the source file
+        reader: function parsing the file, returns a DataFrame or a dict of DataFrames (one per sheet)
+        options: reader options that change the parsed result, part of the cache key
+        cache_dir: cache directory
+        use_cache: if False the file is parsed with reader and the cache is not touched
+        max_bytes: cache size limit, least recently used entries are evicted above it
+    Returns:
+        the DataFrame or dict of DataFrames returned by reader
+    """
+    if not use_cache:
+        return reader()
+
+    key_src = json.dumps({"sha256": file_hash(name, cache_dir), "options": options}, sort_keys=True, default=str)
+    entry_dir = os.path.join(cache_dir, hashlib.sha256(key_src.encode()).hexdigest()[:32])
+    meta_path = os.path.join(entry_dir, "meta.json")
+
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        frames = {frame: _load_frame(os.path.join(entry_dir, f"{i}.arrow"))
+                  for i, frame in enumerate(meta["frames"])}
+        os.utime(entry_dir)
+        print(f"{os.path.basename(name)} loaded from cache")
+        return frames if meta["is_dict"] else frames[meta["frames"][0]]
+
+    parsed = reader()
+    frames = parsed if isinstance(parsed, dict) else {"data": parsed}
+
+    # write into a temporary directory first so a broken run never leaves a partial entry
+    tmp_dir = f"{entry_dir}.tmp{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    for i, df in enumerate(frames.values()):
+        feather.write_feather(df.reset_index(drop=True), os.path.join(tmp_dir, f"{i}.arrow"),
+                              compression="uncompressed")
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({"source": os.path.abspath(name), "frames": list(frames),
+                   "is_dict": isinstance(parsed, dict), "created": time.time()}, f)
+    shutil.rmtree(entry_dir, ignore_errors=True)
+    os.replace(tmp_dir, entry_dir)
+
+    _evict(cache_dir, max_bytes)
+    return parsed
+
+
+def _load_frame(path: str) -> pd.DataFrame:
+    """Load a cached frame through a memory map"""
+    return frame_from_arrow(feather.read_table(path, memory_map=True))
+
+
+def frame_from_arrow(table: pa.Table) -> pd.DataFrame:
+    """Convert an Arrow table to pandas, missing values come back as NaN like pd.read_* gives"""
+    df = table.to_pandas()
+    obj_cols = [col for col in df.columns if df[col].dtype == object]
+    if obj_cols:
+        df[obj_cols] = df[obj_cols].where(df[obj_cols].notna(), np.nan)
+    return df
+
+
+def _entry_size(entry_dir: str) -> int:
+    """Total size of the files of a cache entry"""
+    return sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+
+
+def _entries(cache_dir: str) -> list:
+    """Entry directories of parsed files; the pipeline store, delta state and vocabulary share the directory"""
+    if not os.path.isdir(cache_dir):
+        return []
+    return [entry for entry in os.scandir(cache_dir)
+            if entry.is_dir() and os.path.exists(os.path.join(entry.path, "meta.json"))]
+
+
+def _evict(cache_dir: str, max_bytes: int) -> None:
+    """Remove least recently used entries until the cache fits into max_bytes"""
+    entries = _entries(cache_dir)
+    sizes = {entry.path: _entry_size(entry.path) for entry in entries}
+    total = sum(sizes.values())
+    for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry.path, ignore_errors=True)
+        total -= sizes[entry.path]
+        print(f"Cache entry {entry.name} evicted")
+
+
+def clear_cache(cache_dir: str = CACHE_DIR) -> None:
+    """Remove all parsed file entries and the file hashes; the pipeline store, delta state and vocabulary are kept"""
+    entries = _entries(cache_dir)
+    for entry in entries:
+        shutil.rmtree(entry.path, ignore_errors=True)
+    shutil.rmtree(os.path.join(cache_dir, _HASH_DIR), ignore_errors=True)
+    print(f"{len(entries)} parsed files removed from the cache {cache_dir}")
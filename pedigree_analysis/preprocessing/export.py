@@ -0,0 +1,127 @@
+"""This module contains binary and renumbered integer exports of the cleaned pedigree"""
+
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from preprocessing.pedigree_graph import PedigreeGraph, renumber
+from preprocessing.instrument import instrumented
+
+ID_COLUMNS = ["horse_id", "sire_id", "dam_id", "equinome_id", "bed_id"]
+ROW_GROUP_SIZE = 100000
+
+
+def _schema(ped: pd.DataFrame) -> pa.Schema:
+    """
+    Arrow schema of the pedigree: ids are plain strings, categorical columns are
+    dictionary-encoded and the rest is inferred from the first rows.
+    """
+    fields = []
+    inferred = pa.Schema.from_pandas(ped.head(1000), preserve_index=False)
+    for field in inferred:
+        if field.name in ID_COLUMNS:
+            field = pa.field(field.name, pa.string())
+        elif isinstance(ped[field.name].dtype, pd.CategoricalDtype):
+            field = pa.field(field.name, pa.dictionary(pa.int32(), pa.string()))
+        elif pa.types.is_null(field.type):
+            field = pa.field(field.name, pa.string())
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def _batches(ped: pd.DataFrame, schema: pa.Schema, row_group_size: int):
+    """Convert the pedigree to Arrow one row group at a time"""
+    for start in range(0, len(ped), row_group_size):
+        chunk = ped.iloc[start:start + row_group_size]
+        columns = {}
+        for field in schema:
+            values = chunk[field.name]
+            if pa.types.is_string(field.type):
+                values = values.astype(object).where(values.isna(), values.astype(str))
+            elif pa.types.is_dictionary(field.type):
+                # every batch carries the full category list, so all batches share one dictionary
+                values = values.cat.rename_categories([str(c) for c in values.cat.categories])
+            columns[field.name] = values
+        # arrow-backed pandas columns may come in several chunks, a batch needs contiguous arrays
+        table = pa.Table.from_pandas(pd.DataFrame(columns), schema=schema, preserve_index=False)
+        yield from table.combine_chunks().to_batches()
+
+
+@instrumented
+def write_parquet(ped: pd.DataFrame, path: str, row_group_size: int = ROW_GROUP_SIZE) -> None:
+    """
+    Write the pedigree as Parquet, streamed in row groups with dictionary-encoded columns.
+    Args:
+        ped: cleaned pedigree
+        path: output file
+        row_group_size: rows converted and written at once
+    """
+    schema = _schema(ped)
+    with pq.ParquetWriter(path, schema, use_dictionary=True, compression="snappy") as writer:
+        for batch in _batches(ped, schema, row_group_size):
+            writer.write_batch(batch)
+    print(f"File saved to {path}")
+
+
+@instrumented
+def write_arrow(ped: pd.DataFrame, path: str, row_group_size: int = ROW_GROUP_SIZE) -> None:
+    """
+    Write the pedigree as an uncompressed Arrow IPC file, streamed in record batches,
+    so it can be memory-mapped and reloaded without copies (see read_arrow).
+    Args:
+        ped: cleaned pedigree
+        path: output file
+        row_group_size: rows converted and written at once
+    """
+    schema = _schema(ped)
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        for batch in _batches(ped, schema, row_group_size):
+            writer.write_batch(batch)
+    print(f"File saved to {path}")
+
+
+def read_arrow(path: str) -> pa.Table:
+    """Memory-map an Arrow file written by write_arrow"""
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+@instrumented
+def write_renumbered(ped: pd.DataFrame, prefix: str, id_col: str = "horse_id", sire_col: str = "sire_id",
+                     dam_col: str = "dam_id", row_group_size: int = ROW_GROUP_SIZE) -> None:
+    """
+    Write the pedigree renumbered 1..n with parents before offspring.
+    {prefix}.ped has the columns animal, sire and dam (0 for unknown) separated by spaces,
+    without header, as read by the R pedigree/BLUP tools; {prefix}_idmap.csv maps the
+    renumbered animal back to the original id. Nothing is written if the pedigree contains a cycle.
+    Args:
+        ped: cleaned pedigree
+        prefix: output path without extension
+        id_col, sire_col, dam_col: names of the animal and parent id columns
+        row_group_size: rows written at once
+    """
+    graph = PedigreeGraph.from_frame(ped, id_col=id_col, sire_col=sire_col, dam_col=dam_col)
+    try:
+        order, sire, dam, _ = renumber(graph)
+    except ValueError as error:
+        # the validator only reports cycles, e.g. with missing YOB no link of a loop is removed
+        # files of an earlier run would no longer match the pedigree
+        for path in [f"{prefix}.ped", f"{prefix}_idmap.csv"]:
+            if os.path.exists(path):
+                os.remove(path)
+        print(f"Renumbered pedigree is not written to {prefix}.ped: {error}, see the cycle rows of "
+              f"pedigree_violations.csv")
+        return
+    n = len(order)
+    ids = graph.ids.to_numpy(dtype=object)
+
+    with open(f"{prefix}.ped", "w") as ped_file, open(f"{prefix}_idmap.csv", "w") as map_file:
+        map_file.write(f"animal,{id_col}\n")
+        for start in range(0, n, row_group_size):
+            stop = min(start + row_group_size, n)
+            animal = np.arange(start + 1, stop + 1)
+            np.savetxt(ped_file, np.stack([animal, sire[start:stop], dam[start:stop]], axis=1), fmt="%d")
+            pd.DataFrame({"animal": animal, id_col: ids[order[start:stop]]}) \
+              .to_csv(map_file, header=False, index=False)
+    print(f"Renumbered pedigree of {n} animals saved to {prefix}.ped and {prefix}_idmap.csv")
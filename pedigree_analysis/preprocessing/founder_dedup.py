@@ -0,0 +1,205 @@
+"""This module contains the blocking-based deduplication of founder records in the back pedigree"""
+
+import os
+from difflib import SequenceMatcher
+import numpy as np
+import pandas as pd
+from preprocessing.instrument import instrumented, process_pool, record_dropped
+from preprocessing.normalize import normalize_column
+from preprocessing.pedigree_graph import PedigreeGraph
+
+_SOUNDEX_CODES = {**dict.fromkeys("bfpv", "1"), **dict.fromkeys("cgjkqsxz", "2"), **dict.fromkeys("dt", "3"),
+                  "l": "4", **dict.fromkeys("mn", "5"), "r": "6"}
+
+
+def phonetic_key(name: str, length: int = 6) -> str:
+    """
+    Soundex-style key of a normalized name with the spaces removed, so
+    "sadlers wells" and "sadler's well" end up in the same block.
+    """
+    letters = [c for c in name if c.isalpha()]
+    if not letters:
+        return name
+    key = letters[0]
+    previous = _SOUNDEX_CODES.get(letters[0], "")
+    for c in letters[1:]:
+        code = _SOUNDEX_CODES.get(c, "")
+        if code and code != previous:
+            key += code
+        if c not in "hw":
+            previous = code
+    return key[:length].ljust(length, "0")
+
+
+def _score_pairs(names_a: list, names_b: list) -> np.ndarray:
+    """Name similarity of candidate pairs; runs in a worker process"""
+    return np.array([SequenceMatcher(None, a, b).ratio() for a, b in zip(names_a, names_b)])
+
+
+def _merge_groups(pos_a: np.ndarray, pos_b: np.ndarray, score: np.ndarray, records: pd.DataFrame,
+                  yob_window: int) -> np.ndarray:
+    """
+    Group records of matched pairs, best scores first, with a union-find that only joins two
+    groups if the joined group has at most one known sire and dam and birth years at most
+    yob_window apart, so matches cannot chain records that would not match directly.
+    Returns:
+        np.ndarray: group label of every record, records without a match are their own group
+    """
+    parent = np.arange(len(records))
+    low, high = records["yob"].to_numpy(dtype=float).copy(), records["yob"].to_numpy(dtype=float).copy()
+    sire, dam = records["sire_id"].to_numpy(dtype=object).copy(), records["dam_id"].to_numpy(dtype=object).copy()
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def agree(x, y) -> bool:
+        return pd.isna(x) or pd.isna(y) or x == y
+
+    for k in np.argsort(-score, kind="stable"):
+        a, b = find(pos_a[k]), find(pos_b[k])
+        if a == b or max(high[a], high[b]) - min(low[a], low[b]) > yob_window \
+                or not agree(sire[a], sire[b]) or not agree(dam[a], dam[b]):
+            continue
+        a, b = min(a, b), max(a, b)
+        parent[b] = a
+        low[a], high[a] = min(low[a], low[b]), max(high[a], high[b])
+        sire[a] = sire[a] if pd.notna(sire[a]) else sire[b]
+        dam[a] = dam[a] if pd.notna(dam[a]) else dam[b]
+
+    touched = np.unique(np.concatenate([pos_a, pos_b]))
+    label = np.arange(len(records))
+    label[touched] = [find(i) for i in touched]
+    return label
+
+
+@instrumented
+def find_founder_duplicates(ped: pd.DataFrame, max_yob: int = 1960, yob_window: int = 1,
+                            min_score: float = 0.9, country_unific_dict: dict = None, n_workers: int = None,
+                            pairs_per_task: int = 50000) -> pd.DataFrame:
+    """
+    Find records of the same old animal registered under different ids.
+
+    Records born before max_yob are put into blocks by phonetic name key, normalized sex,
+    normalized country of birth and a bucket of yob_window birth years; only pairs inside a block and its next
+    bucket within yob_window years are scored, on a pool of worker processes. Pairs with
+    conflicting known parents are never merged, and matched pairs are grouped only while
+    the group keeps consistent parents and birth years (see _merge_groups).
+    Args:
+        ped: PedNew dataframe with id, name, sire_id, dam_id, YOB, sex and COB
+        max_yob: only records born before this year are considered
+        yob_window: largest difference of birth years of a matching pair
+        min_score: smallest name similarity (0-1) of a matching pair
+        country_unific_dict: country unification, so "GB" and "great britain" share a block
+        n_workers: number of worker processes, os.cpu_count() if None
+        pairs_per_task: candidate pairs scored per worker task
+    Returns:
+        df: merge map with dup_id, canonical_id and score; the canonical record of a group
+            is the one with most offspring, then the smallest id
+    """
+    yob = pd.to_numeric(ped["YOB"], errors="coerce")
+    old = ped[(yob < max_yob) & ped["id"].notna() & ped["name"].notna()].drop_duplicates(subset="id")
+    names = normalize_column(old["name"], kind="name").astype(object)
+    keys = names.map(phonetic_key, na_action="ignore")
+    sex = normalize_column(old["sex"], kind="sex").astype(object).fillna("?")
+    cob = normalize_column(old["COB"], kind="country", mapping=country_unific_dict, upper=True) \
+        .astype(object).fillna("?")
+
+    records = pd.DataFrame({"id": old["id"].to_numpy(), "name": names.to_numpy(),
+                            "yob": yob[old.index].to_numpy(), "sire_id": old["sire_id"].to_numpy(),
+                            "dam_id": old["dam_id"].to_numpy(),
+                            "block": keys.str.cat([sex, cob], sep="|").to_numpy()})
+    records = records.dropna(subset=["block"]).reset_index(drop=True)
+    records["pos"] = np.arange(len(records))
+    # records within yob_window years fall into the same or the next bucket
+    records["bucket"] = (records["yob"] // max(yob_window, 1)).astype(np.int64)
+
+    same = records.merge(records, on=["block", "bucket"], suffixes=("_a", "_b"))
+    next_bucket = records.merge(records.assign(bucket=records["bucket"] - 1), on=["block", "bucket"],
+                                suffixes=("_a", "_b"))
+    pairs = pd.concat([same[same["pos_a"] < same["pos_b"]], next_bucket], ignore_index=True)
+    pairs = pairs[(pairs["yob_a"] - pairs["yob_b"]).abs() <= yob_window]
+    for parent in ["sire_id", "dam_id"]:
+        conflict = pairs[f"{parent}_a"].notna() & pairs[f"{parent}_b"].notna() & \
+                   (pairs[f"{parent}_a"] != pairs[f"{parent}_b"])
+        pairs = pairs[~conflict]
+    print(f"{len(records)} records born before {max_yob} in {records['block'].nunique()} blocks, "
+          f"{len(pairs)} candidate pairs")
+
+    names_a, names_b = pairs["name_a"].tolist(), pairs["name_b"].tolist()
+    tasks = range(0, len(pairs), pairs_per_task)
+    if len(tasks) > 1:
+        with process_pool(n_workers or os.cpu_count()) as pool:
+            scores = list(pool.map(_score_pairs, [names_a[i:i + pairs_per_task] for i in tasks],
+                                   [names_b[i:i + pairs_per_task] for i in tasks]))
+        score = np.concatenate(scores)
+    else:
+        score = _score_pairs(names_a, names_b)
+
+    matched = pairs[score >= min_score].assign(score=score[score >= min_score])
+    if matched.empty:
+        print("Duplicated founder records are not detected")
+        return pd.DataFrame({"dup_id": [], "canonical_id": [], "score": []})
+
+    # one canonical record per group of matched records
+    label = _merge_groups(matched["pos_a"].to_numpy(), matched["pos_b"].to_numpy(), matched["score"].to_numpy(),
+                          records, yob_window)
+    graph = PedigreeGraph.from_frame(ped)
+    in_group = np.flatnonzero(np.bincount(label, minlength=len(records))[label] > 1)
+    group = records.iloc[in_group][["id"]].assign(
+        group=label[in_group],
+        n_offspring=graph.n_children()[graph.index_of(records["id"].iloc[in_group])])
+    group = group.sort_values(["group", "n_offspring", "id"], ascending=[True, False, True])
+    group["canonical_id"] = group.groupby("group")["id"].transform("first")
+
+    # scores of the pairs that ended up in one group
+    joined = matched[label[matched["pos_a"].to_numpy()] == label[matched["pos_b"].to_numpy()]]
+    best = pd.concat([joined[["id_a", "score"]].rename(columns={"id_a": "id"}),
+                      joined[["id_b", "score"]].rename(columns={"id_b": "id"})]) \
+             .groupby("id")["score"].max()
+    merge_map = group[group["id"] != group["canonical_id"]] \
+        .rename(columns={"id": "dup_id"})[["dup_id", "canonical_id"]]
+    merge_map["score"] = best.reindex(merge_map["dup_id"]).to_numpy()
+    print(f"{len(merge_map)} duplicated founder records are merged into {merge_map['canonical_id'].nunique()} animals")
+    return merge_map.reset_index(drop=True)
+
+
+def remap_ids(values: pd.Series, merge_map: pd.DataFrame) -> pd.Series:
+    """Replace duplicated ids by their canonical id in one vectorized lookup"""
+    mapping = pd.Series(merge_map["canonical_id"].to_numpy(), index=merge_map["dup_id"].to_numpy())
+    return values.where(~values.isin(mapping.index), values.map(mapping))
+
+
+@instrumented
+def merge_founders(ped: pd.DataFrame, pedid_match: pd.DataFrame, merge_map: pd.DataFrame) -> tuple:
+    """
+    Apply a founder merge map to PedNew and PedIDMatch.
+    Duplicated records are dropped, parents known only on a duplicated record are kept on
+    the canonical one and every sire_id/dam_id/horse_id reference is rewritten.
+    Args:
+        ped: PedNew dataframe
+        pedid_match: PedIDMatch dataframe
+        merge_map: merge map from find_founder_duplicates
+    Returns:
+        tuple: (ped, pedid_match) with the duplicates merged
+    """
+    if merge_map.empty:
+        return ped, pedid_match
+
+    ped = ped.copy()
+    dup_rows = ped["id"].isin(merge_map["dup_id"])
+    for col in ["id", "sire_id", "dam_id"]:
+        ped[col] = remap_ids(ped[col], merge_map)
+
+    # parents known only on a duplicated record move to the canonical one
+    dup_parents = ped[dup_rows].groupby("id")[["sire_id", "dam_id"]].first()
+    ped = ped[~dup_rows]
+    record_dropped("duplicate_founder", dup_rows.sum())
+    for col in ["sire_id", "dam_id"]:
+        ped[col] = ped[col].fillna(ped["id"].map(dup_parents[col]))
+
+    pedid_match = pedid_match.copy()
+    pedid_match["horse_id"] = remap_ids(pedid_match["horse_id"], merge_map)
+    return ped, pedid_match
@@ -0,0 +1,108 @@
+"""This module contains the rule-based selection of one genotype record per animal"""
+
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+from preprocessing.instrument import instrumented, record_dropped
+
+# SNPChip density, the denser array wins
+CHIP_PRIORITY = {"SNP670": 3, "SNP70_V2": 2, "SNP70_PVL": 2, "SNP70": 2, "SNP50": 1}
+# highest chip density first, then the most recent batch
+DEFAULT_RULES = [{"column": "SNPChip", "map": CHIP_PRIORITY, "ascending": False},
+                 {"column": "batchID", "ascending": False}]
+EXCLUSION_REASONS = ["not_in_fam", "missing_key", "duplicate_equinome_id", "duplicate_horse_id"]
+EXCLUSION_COLUMNS = ["source", "bed_id", "key", "kept_bed_id", "reason"]
+
+
+def _rank(values: pd.Series, rule: dict) -> np.ndarray:
+    """
+    Turn a column into integer ranks where smaller is better; missing values always rank last.
+    A rule has a column, an optional value -> priority map and an ascending flag.
+    """
+    if rule.get("map") is not None:
+        values = values.map(rule["map"])
+    codes, _ = pd.factorize(values, sort=True, use_na_sentinel=True)
+    codes = codes.astype(np.int64)
+    if not rule.get("ascending", True):
+        codes = np.where(codes >= 0, codes.max(initial=0) - codes, codes)
+    return np.where(codes >= 0, codes, np.iinfo(np.int64).max)
+
+
+@instrumented
+def select_genotypes(sources: Dict[str, pd.DataFrame], key: str, rules: List[dict] = None,
+                     bed_col: str = "id", fam_ids: pd.Index = None,
+                     reason: str = "duplicate_equinome_id") -> tuple:
+    """
+    Keep the best genotype record of every key (e.g. equinomeID) of each source.
+
+    Only the key and rule columns of the sources are stacked; one stable lexsort over
+    (source, key, rules..., original position) puts the best record of every group first,
+    so all sources are deduplicated in a single groupwise pass and every frame is
+    sliced only once at the end. Records without a key cannot be told apart from other
+    genotypes of the same animal, they are excluded with reason missing_key.
+    Args:
+        sources: source name -> genotype records, keys are deduplicated within a source
+        key: column identifying the same genotyped animal
+        rules: priority rules applied in order, each {"column": ..., "map": {...}, "ascending": bool};
+               DEFAULT_RULES (chip density, then batch recency) if None
+        bed_col: name of the bed id column
+        fam_ids: bed ids present in the .fam files; records not in them are excluded first (not_in_fam)
+        reason: exclusion reason recorded for the dropped duplicates
+    Returns:
+        tuple: (kept, exclusions) where kept maps source name to its kept records in the original
+               order and exclusions has source, bed_id, key, kept_bed_id and reason
+    """
+    rules = DEFAULT_RULES if rules is None else rules
+    names = list(sources)
+    source_code = np.concatenate([np.full(len(sources[name]), k, dtype=np.int64) for k, name in enumerate(names)])
+    position = np.concatenate([np.arange(len(sources[name])) for name in names])
+
+    def stacked(col: str) -> pd.Series:
+        return pd.concat([sources[name][col].astype(object) for name in names], ignore_index=True)
+
+    bed_ids = stacked(bed_col)
+    keys = stacked(key)
+    in_fam = bed_ids.isin(fam_ids).to_numpy() if fam_ids is not None else np.ones(len(keys), dtype=bool)
+    key_codes, _ = pd.factorize(keys, use_na_sentinel=True)
+    has_key = key_codes >= 0
+
+    candidates = np.flatnonzero(in_fam & has_key)
+    ranks = [_rank(stacked(rule["column"]).iloc[candidates], rule) for rule in rules]
+    order = candidates[np.lexsort([position[candidates]] + ranks[::-1] +
+                                  [key_codes[candidates], source_code[candidates]])]
+    group = np.stack([source_code[order], key_codes[order]])
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (group[:, 1:] != group[:, :-1]).any(axis=0)
+
+    keep = np.zeros(len(keys), dtype=bool)
+    keep[order[first]] = True
+    best = np.full(len(keys), -1, dtype=np.int64)
+    best[order] = order[first][np.cumsum(first) - 1]
+
+    dropped = np.flatnonzero(~keep)
+    is_dup = in_fam[dropped] & has_key[dropped]
+    exclusions = pd.DataFrame({
+        "source": pd.Categorical(np.array(names, dtype=object)[source_code[dropped]], categories=names),
+        "bed_id": bed_ids.to_numpy()[dropped],
+        "key": keys.to_numpy()[dropped],
+        "kept_bed_id": np.where(is_dup, bed_ids.to_numpy()[np.where(is_dup, best[dropped], 0)], np.nan),
+        "reason": pd.Categorical(np.select([~in_fam[dropped], ~has_key[dropped]], ["not_in_fam", "missing_key"],
+                                           reason), categories=EXCLUSION_REASONS)})
+
+    for excluded_reason, n in exclusions["reason"].value_counts().items():
+        record_dropped(excluded_reason, n)
+
+    kept = {}
+    for k, name in enumerate(names):
+        rows = position[keep & (source_code == k)]
+        kept[name] = sources[name].iloc[rows]
+        reasons = exclusions.loc[exclusions["source"] == name, "reason"].value_counts()
+        print(f"{name}: {reasons['not_in_fam']} records are not in fam files, {reasons['missing_key']} have no {key}, "
+              f"{reasons[reason]} duplicated genotypes by {key} were removed, {len(rows)} records kept")
+    return kept, exclusions
+
+
+def excluded_bed_ids(exclusions: pd.DataFrame) -> list:
+    """Return bed ids of the genotypes to exclude from the analysis; records missing from fam files are not listed"""
+    dups = exclusions[(exclusions["reason"] != "not_in_fam") & exclusions["bed_id"].notna()]
+    return dups["bed_id"].tolist()
@@ -0,0 +1,230 @@
+"""This module contains the incremental (delta) ingestion of new genotyping batches"""
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+from preprocessing.cache import CACHE_DIR
+from preprocessing.export import write_arrow, write_parquet, write_renumbered
+from preprocessing.genotype_dedup import select_genotypes, excluded_bed_ids
+from preprocessing.instrument import instrumented
+from preprocessing.match_n_merge import clear_ped_additional, CATEGORICAL_COLS, DESCRIPTOR_KINDS
+from preprocessing.name_index import INDEX_PATH, build_name_index, resolve_parent_names
+from preprocessing.normalize import normalize_column
+
+STATE_DIR = os.path.join(CACHE_DIR, "state")
+# subdirectory of the state with one diff per delta batch since the last full run
+DELTA_DIR = "deltas"
+# genotype columns of the cleaned pedigree -> columns of the genotype sheets
+GENOTYPE_COLUMNS = {"bed_id": "id", "batch": "batchID", "equinome_id": "equinomeID", "snp_chip": "SNPChip"}
+
+
+def _write_frame(frame: pd.DataFrame, path: str) -> None:
+    """Write a frame as uncompressed Arrow; mixed object columns are stored as strings"""
+    frame = frame.reset_index(drop=True)
+    for col in frame.columns[frame.dtypes == object]:
+        frame[col] = frame[col].where(frame[col].isna(), frame[col].astype(str))
+    feather.write_feather(frame, path, compression="uncompressed")
+
+
+@instrumented
+def save_state(final_pedigree: pd.DataFrame, genotype_exclusions: pd.DataFrame, state_dir: str = STATE_DIR) -> None:
+    """
+    Persist the state a later delta run starts from; deltas of earlier batches are folded into it and removed.
+    Args:
+        final_pedigree: cleaned pedigree, it holds the chosen genotype of every animal
+        genotype_exclusions: exclusion table of select_genotypes
+        state_dir: directory of the state files
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    for name, frame in [("pedigree", final_pedigree), ("exclusions", genotype_exclusions)]:
+        # the previous state may still be memory-mapped, so it is replaced instead of overwritten
+        path = os.path.join(state_dir, f"{name}.arrow")
+        _write_frame(frame, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+    shutil.rmtree(os.path.join(state_dir, DELTA_DIR), ignore_errors=True)
+    print(f"Pedigree state of {len(final_pedigree)} animals saved to {state_dir}")
+
+
+@instrumented
+def save_delta(diff: dict, state_dir: str = STATE_DIR) -> None:
+    """
+    Append the diff of a batch (see apply_batch) to the state, so a delta run writes only its batch.
+    Every delta is a directory with the added animals, the new genotype of the updated
+    animals by row and the new exclusions; it is renamed into place once complete.
+    """
+    delta_dir = os.path.join(state_dir, DELTA_DIR)
+    os.makedirs(delta_dir, exist_ok=True)
+    done = [name for name in os.listdir(delta_dir) if name.isdigit()]
+    path = os.path.join(delta_dir, f"{len(done) + 1:05d}")
+    os.makedirs(f"{path}.tmp", exist_ok=True)
+    updated = diff["updated"][list(GENOTYPE_COLUMNS)].assign(row=diff["updated"].index.to_numpy())
+    for name, frame in [("added", diff["added"]), ("updated", updated), ("exclusions", diff["exclusions"])]:
+        _write_frame(frame, os.path.join(f"{path}.tmp", f"{name}.arrow"))
+    os.replace(f"{path}.tmp", path)
+    print(f"Batch diff of {len(diff['added'])} added and {len(updated)} updated animals saved to {path}")
+
+
+@instrumented
+def load_state(state_dir: str = STATE_DIR) -> dict:
+    """
+    Load the state saved by save_state with the deltas of later batches applied in order.
+    Returns:
+        dict: pedigree and exclusions dataframes
+    Raises:
+        FileNotFoundError: if no full run has saved a state yet
+    """
+    paths = {name: os.path.join(state_dir, f"{name}.arrow") for name in ["pedigree", "exclusions"]}
+    for path in paths.values():
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} does not exist, run the full pipeline first")
+    state = {name: feather.read_feather(path, memory_map=True) for name, path in paths.items()}
+
+    delta_dir = os.path.join(state_dir, DELTA_DIR)
+    deltas = sorted(name for name in os.listdir(delta_dir) if name.isdigit()) if os.path.isdir(delta_dir) else []
+    for name in deltas:
+        delta = {part: feather.read_feather(os.path.join(delta_dir, name, f"{part}.arrow"))
+                 for part in ["added", "updated", "exclusions"]}
+        pedigree = state["pedigree"]
+        if not delta["updated"].empty:
+            pedigree = pedigree.copy()
+            rows = delta["updated"]["row"].to_numpy()
+            for col in GENOTYPE_COLUMNS:
+                pedigree[col] = pedigree[col].astype(object)
+                pedigree.iloc[rows, pedigree.columns.get_loc(col)] = delta["updated"][col].to_numpy()
+        state["pedigree"] = pd.concat([pedigree, delta["added"]], ignore_index=True)
+        state["exclusions"] = pd.concat([state["exclusions"], delta["exclusions"]], ignore_index=True)
+    if deltas:
+        for col in CATEGORICAL_COLS:
+            if col in state["pedigree"].columns:
+                state["pedigree"][col] = state["pedigree"][col].astype("category")
+        print(f"{len(deltas)} batch deltas applied to the pedigree state")
+    return state
+
+
+def _name_index(pedigree: pd.DataFrame, path: str = INDEX_PATH) -> pd.DataFrame:
+    """Load the name index of the last full run, rebuild it from the Pedigree #1 rows if it is missing"""
+    if os.path.exists(path):
+        return feather.read_feather(path, memory_map=True)
+    ped1 = pedigree[pedigree["status"].astype(str) != "44444"]
+    return build_name_index(ped1.rename(columns={"horse_id": "id", "horse_name": "name"}))
+
+
+@instrumented
+def apply_batch(state: dict, batch: pd.DataFrame, fam_ids: pd.Index, rules: list, country_unific_dict: dict,
+                col_order: list) -> tuple:
+    """
+    Add a new genotyping batch to the pedigree state.
+
+    Only records of equinomeIDs present in the batch are compared: the new records compete
+    with each other and with the genotype currently chosen for the same equinomeID, which
+    already is the best one of all earlier records. Batch records of new equinomeIDs become
+    new animals the way Pedigree #2 records do, with sire and dam names resolved through
+    the persisted name index.
+    Args:
+        state: state from load_state
+        batch: new records in the Pedigree #2 format (id, batchID, equinomeID, SNPChip, ..., Sire, Dam)
+        fam_ids: bed ids of the new .fam entries
+        rules: genotype priority rules, see select_genotypes
+        country_unific_dict: country unification of the full run
+        col_order: column order of the cleaned pedigree
+    Returns:
+        tuple: (state, diff) where state is the updated state and diff has the added
+               animals, the updated animals and the new exclusions
+    Raises:
+        ValueError: if fam_ids is empty, every record would be excluded as not_in_fam
+    """
+    if len(fam_ids) == 0:
+        raise ValueError("No bed ids given for the batch, pass the .fam files of its genotypes")
+    pedigree, exclusions = state["pedigree"], state["exclusions"]
+    # records missing from the .fam files of an earlier batch are checked again,
+    # their genotypes may have been delivered since
+    decided = exclusions.loc[exclusions["reason"] != "not_in_fam", "bed_id"]
+    seen = batch["id"].isin(pedigree["bed_id"]) | batch["id"].isin(decided)
+    if seen.any():
+        print(f"{int(seen.sum())} records of the batch were already ingested and are skipped")
+        batch = batch[~seen]
+    # batch records without an equinomeID are excluded as missing_key, kept records all have one
+    kept, batch_exclusions = select_genotypes({"batch": batch}, key="equinomeID", rules=rules, bed_col="id",
+                                              fam_ids=fam_ids, reason="duplicate_equinome_id")
+    batch = kept["batch"]
+
+    # records currently chosen for the equinomeIDs of the batch compete with the batch records;
+    # isin matches missing to missing, so ungenotyped animals are left out explicitly
+    affected = np.flatnonzero((pedigree["equinome_id"].notna() &
+                               pedigree["equinome_id"].isin(batch["equinomeID"].dropna())).to_numpy())
+    current = pedigree.iloc[affected][list(GENOTYPE_COLUMNS)].rename(columns=GENOTYPE_COLUMNS) \
+                      .assign(row=affected)
+    # an animal with several records holds its genotype on each of them, it competes once
+    candidates = pd.concat([current.drop_duplicates(subset="equinomeID"),
+                            batch[list(GENOTYPE_COLUMNS.values())].assign(row=-1)], ignore_index=True)
+    winners, update_exclusions = select_genotypes({"update": candidates}, key="equinomeID", rules=rules,
+                                                  bed_col="id", reason="duplicate_equinome_id")
+    winners = winners["update"]
+    update_exclusions["source"] = np.where(update_exclusions["bed_id"].isin(current["id"]), "pedigree", "batch")
+
+    # existing animals whose chosen genotype is replaced by a batch record
+    replaced = winners[(winners["row"] < 0) & winners["equinomeID"].notna() &
+                       winners["equinomeID"].isin(current["equinomeID"])]
+    replaced = current[["equinomeID", "row"]].dropna(subset=["equinomeID"]) \
+        .merge(replaced.drop(columns="row"), on="equinomeID")
+    rows = replaced["row"].to_numpy()
+    if len(rows) > 0:
+        pedigree = pedigree.copy()
+        for col, batch_col in GENOTYPE_COLUMNS.items():
+            pedigree[col] = pedigree[col].astype(object)
+            pedigree.iloc[rows, pedigree.columns.get_loc(col)] = replaced[batch_col].to_numpy()
+    updated = pedigree.iloc[rows]
+
+    # new equinomeIDs become new animals
+    new = batch[~batch["equinomeID"].isin(current["equinomeID"])]
+    added = pd.DataFrame(columns=col_order)
+    if not new.empty:
+        parent_ids, _ = resolve_parent_names(new, _name_index(pedigree))
+        added = clear_ped_additional(new, parent_ids)
+        for col in ["country_reported", "COB"]:
+            added[col] = normalize_column(added[col], kind="country", mapping=country_unific_dict, upper=True)
+        for col, kind in DESCRIPTOR_KINDS.items():
+            if col in added.columns:
+                added[col] = normalize_column(added[col], kind=kind)
+        added = added.reindex(columns=col_order)
+        added["YOB"] = added["YOB"].astype("float").astype("Int64")
+
+    new_exclusions = pd.concat([batch_exclusions.assign(source="batch"), update_exclusions], ignore_index=True)
+    pedigree = pd.concat([pedigree, added], ignore_index=True)
+    for col in CATEGORICAL_COLS:
+        if col in pedigree.columns:
+            pedigree[col] = pedigree[col].astype("category")
+    print(f"Batch of {len(batch)} genotypes: {len(added)} animals added, {len(updated)} animals got a new "
+          f"genotype, {len(excluded_bed_ids(new_exclusions))} bed ids excluded")
+    return ({"pedigree": pedigree, "exclusions": pd.concat([exclusions, new_exclusions], ignore_index=True)},
+            {"added": added, "updated": updated, "exclusions": new_exclusions})
+
+
+@instrumented
+def write_delta(state: dict, diff: dict, results_dir: str = "results/") -> None:
+    """
+    Apply a batch diff to the result files of the last run.
+    New animals and exclusions are appended; cleaned_pedigree.csv is only rewritten
+    when existing animals got a new genotype. The Parquet, Arrow and renumbered files
+    cannot be appended to and are written again from the updated pedigree, so no result
+    file is left behind the csv.
+    """
+    pedigree_path = os.path.join(results_dir, "cleaned_pedigree.csv")
+    if diff["updated"].empty:
+        diff["added"].to_csv(pedigree_path, mode="a", header=False, index=False)
+    else:
+        state["pedigree"].to_csv(pedigree_path, index=False)
+    print(f"File updated {pedigree_path}")
+    prefix = os.path.join(results_dir, "cleaned_pedigree")
+    write_parquet(state["pedigree"], f"{prefix}.parquet")
+    write_arrow(state["pedigree"], f"{prefix}.arrow")
+    write_renumbered(state["pedigree"], prefix)
+
+    diff["exclusions"].to_csv(os.path.join(results_dir, "genotype_exclusions.csv"), mode="a", header=False,
+                              index=False)
+    with open(os.path.join(results_dir, "bedids2exclude.txt"), "a") as f:
+        for bedid in excluded_bed_ids(diff["exclusions"]):
+            f.write(f"{bedid} {bedid}\n")
+    print(f"File updated {os.path.join(results_dir, 'bedids2exclude.txt')}")
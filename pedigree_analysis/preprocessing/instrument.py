@@ -0,0 +1,335 @@
+"""This module contains the instrumentation of pipeline stages and preprocessing functions and the JSON run report
+
+Usage (from the pedigree_analysis directory), to compare two run reports stage by stage:
+    python -m preprocessing.instrument results/run_report_20240301_120000.json results/run_report_20240308_120000.json
+"""
+
+import argparse
+import cProfile
+import functools
+import inspect
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List
+import numpy as np
+import pandas as pd
+import psutil
+
+# report of the run in progress, set while a RunReport is entered
+_active = None
+# numbers the .prof files of a process, a function can be profiled several times a second
+_profile_ids = itertools.count()
+
+
+def measure(func: Callable, *args, interval: float = 0.005, **kwargs) -> tuple:
+    """
+    Call func and measure it.
+    Returns:
+        tuple: (result, record) where record has wall and CPU seconds (of the process and of the
+               worker processes it waited for) and the peak resident memory above the memory at
+               the start of the call, sampled every interval seconds
+    """
+    process = psutil.Process()
+    start_rss = process.memory_info().rss
+    peak = [start_rss]
+    done = threading.Event()
+
+    def sample() -> None:
+        while not done.wait(interval):
+            peak[0] = max(peak[0], process.memory_info().rss)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    wall, cpu, start_times = time.perf_counter(), time.process_time(), os.times()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        end_times = os.times()
+        done.set()
+        sampler.join()
+    peak[0] = max(peak[0], process.memory_info().rss)
+    children = (end_times.children_user - start_times.children_user) + \
+               (end_times.children_system - start_times.children_system)
+    return result, {"wall_s": wall, "cpu_s": cpu, "children_cpu_s": children,
+                    "peak_mb": (peak[0] - start_rss) / 1024 ** 2}
+
+
+def count_rows(values: dict) -> dict:
+    """
+    Return the number of rows of every dataframe, series, array, set or Arrow table among the values
+    and the dicts they hold
+    """
+    rows = {}
+    for name, value in values.items():
+        if isinstance(value, (pd.DataFrame, pd.Series, pd.Index, np.ndarray, set, frozenset)):
+            rows[name] = len(value)
+        elif hasattr(value, "num_rows"):
+            rows[name] = value.num_rows
+        elif isinstance(value, dict):
+            rows.update({f"{name}.{key}": n for key, n in count_rows(value).items()})
+    return rows
+
+
+def record_dropped(reason: str, n: int) -> None:
+    """
+    Count rows (or values such as parent links) dropped for a reason by the running function.
+    Counts add up through the enclosing functions and stage; nothing is recorded without an active report.
+    """
+    if _active is not None and _active.frames and n > 0:
+        dropped = _active.frames[-1]["dropped"]
+        dropped[reason] = dropped.get(reason, 0) + int(n)
+
+
+def instrumented(func: Callable) -> Callable:
+    """
+    Decorator recording a preprocessing function in the active run report
+    (see RunReport.call); without an active report the function is called directly.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _active is None:
+            return func(*args, **kwargs)
+        return _active.call("function", func.__name__, func, args, kwargs)
+    return wrapper
+
+
+def process_pool(max_workers: int, **kwargs) -> ProcessPoolExecutor:
+    """
+    Return a process pool whose workers are not forked from this process.
+    Instrumented calls run the memory sampler thread of measure, and a process forked while
+    another thread holds a lock (of the allocator, of logging, ...) can deadlock, so workers
+    are started by a fork server, or spawned where there is none.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method), **kwargs)
+
+
+def worker_settings() -> dict:
+    """Return the settings of the active report for the reports of worker processes, None without an active report"""
+    if _active is None:
+        return None
+    return {"profile": _active.profile, "trace_memory": _active.trace_memory, "profile_dir": _active.profile_dir,
+            "top": _active.top}
+
+
+def run_in_worker(settings: dict, name: str, func: Callable, *args, **kwargs) -> tuple:
+    """
+    Call func in a worker process and record it under a report of its own built from settings
+    (see worker_settings), so it is measured and profiled like a call of the parent process.
+    Returns:
+        tuple: (result, record) where record is None without settings; the parent adds it
+               to its report with record_worker
+    """
+    if settings is None:
+        return func(*args, **kwargs), None
+    with RunReport(**settings) as report:
+        root = {"dropped": {}, "functions": [], "alloc_peak": 0}
+        report.frames.append(root)
+        result = report.call("function", name, func, args, kwargs)
+    return result, {**root["functions"][0], "pid": os.getpid()}
+
+
+def record_worker(record: dict) -> None:
+    """Add the record of a call in a worker process (see run_in_worker) to the running function or stage"""
+    if _active is None or not _active.frames or record is None:
+        return
+    frame = _active.frames[-1]
+    frame["functions"].append(record)
+    for reason, n in record["dropped"].items():
+        frame["dropped"][reason] = frame["dropped"].get(reason, 0) + n
+
+
+class RunReport:
+    """
+    Collects one record per pipeline stage with the instrumented functions it called.
+
+    Every record has wall and CPU time, peak RSS above the start of the call, input and
+    output row counts and rows dropped per reason. Optionally stages or functions named in
+    profile run under cProfile (the stats are saved to profile_dir and the top functions are
+    put in the record) and trace_memory runs tracemalloc for the peak of Python allocations
+    and the allocation sites that grew the most in every stage.
+    Attributes:
+        profile: names of the stages or functions to profile, an empty list profiles every stage, None none
+        trace_memory: trace Python allocations with tracemalloc, slows the run down noticeably
+        profile_dir: directory of the .prof files
+        stages: stage records in execution order
+    """
+
+    def __init__(self, profile: List[str] = None, trace_memory: bool = False, profile_dir: str = "results/profiles",
+                 top: int = 15) -> None:
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.top = top
+        self.stages = []
+        self.frames = []
+        self.profiling = False
+        self.started = None
+        self.finished = None
+
+    def __enter__(self) -> "RunReport":
+        global _active
+        _active = self
+        self.started = time.time()
+        if self.trace_memory:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        global _active
+        _active = None
+        self.finished = time.time()
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def _profiled(self, kind: str, name: str) -> bool:
+        if self.profile is None or self.profiling:
+            return False
+        return name in self.profile or (not self.profile and kind == "stage")
+
+    def call(self, kind: str, name: str, func: Callable, args: tuple, kwargs: dict):
+        """
+        Call func(*args, **kwargs) and record it as a stage or as a function of the running stage.
+        Returns:
+            the result of func
+        """
+        try:
+            bound = inspect.signature(func).bind(*args, **kwargs).arguments
+        except (TypeError, ValueError):
+            bound = {**{str(i): arg for i, arg in enumerate(args)}, **kwargs}
+        frame = {"kind": kind, "name": name, "rows_in": count_rows(bound), "dropped": {}, "functions": [],
+                 "alloc_peak": 0}
+        self.frames.append(frame)
+
+        profiler = cProfile.Profile() if self._profiled(kind, name) else None
+        snapshot = tracemalloc.take_snapshot() if self.trace_memory and kind == "stage" else None
+        if self.trace_memory:
+            alloc_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        def run():
+            if profiler is None:
+                return func(*args, **kwargs)
+            self.profiling = True
+            try:
+                return profiler.runcall(func, *args, **kwargs)
+            finally:
+                self.profiling = False
+
+        try:
+            result, record = measure(run)
+        finally:
+            self.frames.pop()
+
+        if isinstance(result, dict):
+            outputs = result
+        elif isinstance(result, tuple):
+            outputs = {str(i): value for i, value in enumerate(result)}
+        else:
+            outputs = {"result": result}
+        record = {"name": name, **record, "rows_in": frame["rows_in"], "rows_out": count_rows(outputs),
+                  "dropped": frame["dropped"]}
+        if self.trace_memory:
+            alloc_peak = max(frame["alloc_peak"], tracemalloc.get_traced_memory()[1])
+            record["peak_alloc_mb"] = (alloc_peak - alloc_start) / 1024 ** 2
+            if self.frames:
+                self.frames[-1]["alloc_peak"] = max(self.frames[-1]["alloc_peak"], alloc_peak)
+        if snapshot is not None:
+            stats = tracemalloc.take_snapshot().compare_to(snapshot, "lineno")[:self.top]
+            record["top_allocations"] = [{"line": str(stat.traceback), "size_mb": stat.size_diff / 1024 ** 2}
+                                         for stat in stats]
+        if profiler is not None:
+            record["profile"] = self._save_profile(name, profiler)
+        if kind == "stage":
+            record["status"] = "run"
+            record["functions"] = frame["functions"]
+            self.stages.append(record)
+        elif frame["functions"]:
+            # instrumented functions it called, e.g. the per-file loads of worker processes
+            record["functions"] = frame["functions"]
+        if self.frames:
+            parent = self.frames[-1]
+            for reason, n in frame["dropped"].items():
+                parent["dropped"][reason] = parent["dropped"].get(reason, 0) + n
+            if kind == "function":
+                parent["functions"].append(record)
+        return result
+
+    def _save_profile(self, name: str, profiler: cProfile.Profile) -> list:
+        """Save the cProfile stats of a call and return its top functions by cumulative time"""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{next(_profile_ids)}.prof")
+        profiler.dump_stats(path)
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top]
+        print(f"Profile of {name} saved to {path}")
+        return [{"function": f"{file}:{line}({func})", "ncalls": ncalls, "tottime_s": tottime, "cumtime_s": cumtime}
+                for (file, line, func), (_, ncalls, tottime, cumtime, _) in rows]
+
+    def loaded(self, name: str, outputs: dict) -> None:
+        """Record a stage whose outputs were loaded from the pipeline store"""
+        self.stages.append({"name": name, "status": "loaded", "rows_out": count_rows(outputs)})
+
+    def to_dict(self) -> dict:
+        return {"started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "wall_s": (self.finished or time.time()) - self.started,
+                "command": sys.argv, "profile": self.profile, "trace_memory": self.trace_memory,
+                "stages": self.stages}
+
+    def save(self, path: str) -> None:
+        """Write the report as JSON"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        print(f"Run report saved to {path}")
+
+
+def report_table(path: str) -> pd.DataFrame:
+    """Flatten the stages of a run report to one row per stage and instrumented function, nested calls included"""
+    with open(path) as f:
+        report = json.load(f)
+    rows = []
+
+    def add_functions(stage: str, functions: list) -> None:
+        for function in functions:
+            rows.append({"stage": stage, **function})
+            add_functions(stage, function.get("functions", []))
+
+    for stage in report["stages"]:
+        rows.append({"stage": stage["name"], "name": stage["name"], **stage})
+        add_functions(stage["name"], stage.get("functions", []))
+    table = pd.DataFrame(rows)
+    for col in ["rows_in", "rows_out", "dropped"]:
+        if col in table.columns:
+            table[col] = table[col].map(lambda counts: sum(counts.values()) if isinstance(counts, dict) else np.nan)
+    return table.drop(columns=["functions", "profile", "top_allocations"], errors="ignore")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the stage timings of two run reports")
+    parser.add_argument("before", help="earlier run report")
+    parser.add_argument("after", help="later run report")
+    args = parser.parse_args()
+
+    columns = ["wall_s", "peak_mb", "rows_out", "dropped"]
+    # functions called several times in a stage are summed, rows keep the order of the runs
+    before, after = [report_table(path).groupby(["stage", "name"], sort=False)[columns].sum(min_count=1)
+                     for path in [args.before, args.after]]
+    keys = before.index.append(after.index).unique()
+    merged = before.reindex(keys).join(after.reindex(keys), lsuffix="_before", rsuffix="_after").reset_index()
+    merged["slowdown"] = merged["wall_s_after"] / merged["wall_s_before"]
+    print(merged.round(3).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
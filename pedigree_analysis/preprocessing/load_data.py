@@ -1,38 +1,48 @@
 """This module contains functions for reading initial pedigree files and accompanied genotypes"""
 
+from typing import Dict, Union
 import pandas as pd
+from preprocessing.cache import cached_read
+from preprocessing.instrument import instrumented
+from preprocessing.plink import read_fam_table
 
+NA_VALUES = [" ", "", "None"]
 
-def read_pedigree_sheets(name: str) -> pd.DataFrame:
-    """"""
 
-    sheet_to_df_map = pd.read_excel(name, 
-                                sheet_name=None, 
-                                dtype=str,
-                                na_values=[" ", "", "None"])
-    
-    pedid_match = sheet_to_df_map["PedIDMatch"]
-    ped_df = sheet_to_df_map["PedNew"]
-    geno_id = sheet_to_df_map["GenotypeIDs"]
+def read_pedigree_sheets(name: str, use_cache: bool = True) -> tuple:
+    """Read the PedIDMatch, PedNew and GenotypeIDs sheets of a Pedigree #1 workbook (see read_table)"""
+    sheets = read_table(name, use_cache=use_cache)
+    return sheets["PedIDMatch"], sheets["PedNew"], sheets["GenotypeIDs"]
 
-    return pedid_match, ped_df, geno_id
 
-
-def get_pedigree_csv(name: str) -> pd.DataFrame:
-    """"""
-    ped_addit = pd.read_csv(name, 
-                        dtype=str, na_values=[" ", "", "None"], 
-                        usecols=range(12)).query("id.notna().values") # to read only those rows that has an actual records
-
-    return ped_addit
+def get_pedigree_csv(name: str, use_cache: bool = True) -> pd.DataFrame:
+    """Read the 12 columns of a Pedigree #2 csv file without its trailing empty rows (see read_table)"""
+    ped_addit = read_table(name, use_cache=use_cache).iloc[:, :12]
+    return ped_addit[ped_addit["id"].notna().to_numpy()]
 
 
 def read_fam(name: str) -> set:
     """
     Read a .fam file and extract a set of IDs
     """
-    fam_df = pd.read_csv(name, sep="\s+", header=None)
-    ids = set(fam_df[1].unique())
-    return ids
+    return set(read_fam_table(name)["iid"].unique())
+
 
-    
\ No newline at end of file
+@instrumented
+def read_table(name: str, use_cache: bool = True) -> Union[pd.DataFrame, Dict[str, pd.DataFrame]]:
+    """
+    Read a csv file, or every sheet of an Excel workbook, with all values as strings.
+    Args:
+        name: path to a .csv or .xlsx file
+        use_cache: read through the parsed file cache
+    Returns:
+        the DataFrame of a csv file or a dict of sheet name -> DataFrame of a workbook
+    """
+    if name.endswith((".xlsx", ".xls")):
+        return cached_read(name, lambda: pd.read_excel(name, sheet_name=None, dtype=str, na_values=NA_VALUES),
+                           options={"reader": "read_excel", "sheet_name": None, "dtype": "str",
+                                    "na_values": NA_VALUES},
+                           use_cache=use_cache)
+    return cached_read(name, lambda: pd.read_csv(name, dtype=str, na_values=NA_VALUES),
+                       options={"reader": "read_csv", "dtype": "str", "na_values": NA_VALUES},
+                       use_cache=use_cache)
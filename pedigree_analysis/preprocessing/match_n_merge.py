@@ -2,7 +2,14 @@
 
 import pandas as pd
 from preprocessing.utils import clear_string_val, change_sex
+from preprocessing.instrument import instrumented
+from preprocessing.normalize import normalize_column
 
+CATEGORICAL_COLS = ["status", "MOB", "sex", "colour", "COB", "batch", "snp_chip", "country_reported"]
+# descriptive columns normalized through the vocabulary, column -> kind of values
+DESCRIPTOR_KINDS = {"horse_name": "name", "sex": "sex", "colour": "colour"}
+
+@instrumented
 def merge_1stdataframes(ped_df: pd.DataFrame, pedid_match: pd.DataFrame, geno_id: pd.DataFrame) -> pd.DataFrame:
     """
     Merge filtered ped_df, pedid_match, and filtered geno_id into a single dataframe
@@ -41,8 +48,11 @@ def merge_1stdataframes(ped_df: pd.DataFrame, pedid_match: pd.DataFrame, geno_id
 # there are 127 individuals with years of birth not matching between pedigree and genotype data, will keeping yobs from pedigree
 
 
-def clear_ped_additional(ped2nd: pd.DataFrame) -> pd.DataFrame:
-    """This function changes the format of the additional dataset of pedigree to be able to concatenate with the base one"""
+@instrumented
+def clear_ped_additional(ped2nd: pd.DataFrame, parent_ids: pd.DataFrame = None) -> pd.DataFrame:
+    """This function changes the format of the additional dataset of pedigree to be able to concatenate with the base one.
+    Sire and Dam names are replaced by the horse ids resolved in parent_ids (see resolve_parent_names), without it
+    all animals become founders"""
     ped2nd_cleaned = ped2nd.copy()
     ped2nd_cleaned = ped2nd_cleaned.drop(columns=["Sire", "Dam"])
     ped2nd_cleaned = ped2nd_cleaned.rename(columns={"id":"bed_id", "batchID":"batch",
@@ -52,35 +62,50 @@ def clear_ped_additional(ped2nd: pd.DataFrame) -> pd.DataFrame:
                                     "Country of Birth":"COB"})
     
     ped2nd_cleaned = ped2nd_cleaned.assign(status="44444", sire_id=None, dam_id=None, genotyped=True)
+    if parent_ids is not None:
+        ped2nd_cleaned[["sire_id", "dam_id"]] = parent_ids[["sire_id", "dam_id"]]
     ped2nd_cleaned["sex"] = change_sex(ped2nd_cleaned["sex"])
     ped2nd_cleaned["horse_id"] = ped2nd_cleaned["bed_id"].copy()
     
     return ped2nd_cleaned
 
+@instrumented
 def modifying_countries(ped_1st: pd.DataFrame, ped2nd: pd.DataFrame, 
                         country_unific_dict: dict) -> pd.DataFrame:
-    """"""
+    """Normalize country columns, unify them with country_unific_dict and upper-case them as categoricals"""
     cols = ["country_reported", "COB"]
 
-    ped_1st[cols] = ped_1st[cols].apply(clear_string_val)
-    ped2nd[cols] = ped2nd[cols].apply(clear_string_val)
+    # normalization, unification and upper-casing run once per distinct value shared by all 4 columns
+    for ped in (ped_1st, ped2nd):
+        for col in cols:
+            ped[col] = normalize_column(ped[col], kind="country", mapping=country_unific_dict, upper=True)
 
-    ped_1st[cols] = ped_1st[cols].replace(country_unific_dict)
-    ped2nd[cols] = ped2nd[cols].replace(country_unific_dict)
-    
-    ped_1st[cols] = ped_1st[cols].apply(lambda x: x.str.upper())
-    ped2nd[cols] = ped2nd[cols].apply(lambda x: x.str.upper())
+    return ped_1st, ped2nd
+
+@instrumented
+def normalize_descriptors(ped_1st: pd.DataFrame, ped2nd: pd.DataFrame) -> pd.DataFrame:
+    """Normalize name, sex and colour columns (see DESCRIPTOR_KINDS) of both pedigrees as categoricals"""
+    for ped in (ped_1st, ped2nd):
+        for col, kind in DESCRIPTOR_KINDS.items():
+            # Pedigree #2 has no colour
+            if col in ped.columns:
+                ped[col] = normalize_column(ped[col], kind=kind)
 
     return ped_1st, ped2nd
 
 import pandas as pd
 
+@instrumented
 def concat_peds(ped_1st: pd.DataFrame, ped2nd: pd.DataFrame, col_order) -> pd.DataFrame:
     """Combine all pedigree datasets into one"""
     
     alltogether_pedigree = pd.concat([ped_1st, ped2nd], ignore_index=True)    
     alltogether_pedigree = alltogether_pedigree.reindex(columns=col_order)
     alltogether_pedigree["YOB"] = alltogether_pedigree["YOB"].astype("float").astype("Int64")
+    # low-cardinality columns are kept as categoricals to save memory
+    for col in CATEGORICAL_COLS:
+        if col in alltogether_pedigree.columns:
+            alltogether_pedigree[col] = alltogether_pedigree[col].astype("category")
     print(alltogether_pedigree.shape)
     
     return alltogether_pedigree
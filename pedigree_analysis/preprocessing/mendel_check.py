@@ -0,0 +1,182 @@
+"""This module contains the genotype-based Mendelian error check of pedigree trios"""
+
+import os
+from typing import List
+import numpy as np
+import pandas as pd
+from analysis.family_structure import calc_trios
+from preprocessing.plink import BedReader
+from preprocessing.instrument import instrumented, process_pool
+
+# swapping a1/a2 turns hom a1 into hom a2, het and missing stay
+_FLIP_CODES = np.array([3, 1, 2, 0], dtype=np.uint8)
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.int64)
+# arrays and shared variants of a worker process, set by _init_worker
+_worker = {}
+
+
+def _planes(codes: np.ndarray) -> tuple:
+    """Split 2-bit codes into bit-packed hom a1, het, hom a2 and missing planes along variants"""
+    lo, hi = codes & 1, codes >> 1
+    planes = (~(lo | hi) & 1, hi & ~lo & 1, lo & hi, lo & ~hi & 1)
+    return tuple(np.packbits(plane.astype(bool), axis=1) for plane in planes)
+
+
+def _count(bits: np.ndarray) -> np.ndarray:
+    """Number of set bits per row of a bit-packed array"""
+    return _POPCOUNT[bits].sum(axis=1)
+
+
+def _shared_variants(readers: List[BedReader]) -> tuple:
+    """
+    Find variants present on every array by SNP name.
+    Names used for several variants of one array cannot be aligned and are left out.
+    Returns:
+        tuple: (variant indices per reader, flip flag per reader) aligned on the first reader's order
+    """
+    ambiguous = pd.Index([], dtype=object)
+    for reader in readers:
+        ambiguous = ambiguous.union(reader.bim.loc[reader.bim["snp"].duplicated(), "snp"].unique())
+    if len(ambiguous) > 0:
+        print(f"{len(ambiguous)} SNP names are used for several variants of an array and are not checked, "
+              f"e.g. {ambiguous[:5].tolist()}")
+    snps = readers[0].bim["snp"]
+    snps = snps[~snps.isin(ambiguous)]
+    for reader in readers[1:]:
+        snps = snps[snps.isin(reader.bim["snp"])]
+    ref_a1 = readers[0].bim.set_index("snp").loc[snps, "a1"].to_numpy()
+
+    variant_idx, flips = [], []
+    for reader in readers:
+        bim = reader.bim.reset_index().set_index("snp").loc[snps]
+        variant_idx.append(bim["index"].to_numpy())
+        flips.append(bim["a1"].to_numpy() != ref_a1)
+    return variant_idx, flips
+
+
+def _locate(readers: List[BedReader], bed_ids: np.ndarray) -> tuple:
+    """Return the array and .bed position of every bed id, the first array wins for ids on several arrays"""
+    file_of = np.full(len(bed_ids), -1, dtype=np.int64)
+    pos_of = np.full(len(bed_ids), -1, dtype=np.int64)
+    for k, reader in enumerate(readers):
+        positions = pd.Index(reader.fam["iid"]).get_indexer(pd.Index(bed_ids))
+        new = (file_of < 0) & (positions >= 0)
+        file_of[new], pos_of[new] = k, positions[new]
+    return file_of, pos_of
+
+
+def _gather(readers: List[BedReader], variant_idx: list, flips: list, file_of: np.ndarray,
+            pos_of: np.ndarray, start: int, stop: int) -> np.ndarray:
+    """Collect the codes of one trio member for a block of shared variants from whichever array holds it"""
+    codes = np.empty((len(file_of), stop - start), dtype=np.uint8)
+    for k, reader in enumerate(readers):
+        members = np.flatnonzero(file_of == k)
+        if members.size == 0:
+            continue
+        block = reader.read_codes(pos_of[members], variant_idx[k][start:stop])
+        flip = flips[k][start:stop]
+        if flip.any():
+            block[:, flip] = _FLIP_CODES[block[:, flip]]
+        codes[members] = block
+    return codes
+
+
+def _init_worker(prefixes: List[str], variant_idx: list, flips: list) -> None:
+    """Open the arrays once per worker process and keep the shared variants computed by the parent"""
+    _worker["readers"] = [BedReader(prefix) for prefix in prefixes]
+    _worker["variant_idx"], _worker["flips"] = variant_idx, flips
+
+
+def _check_trio_block(file_of: np.ndarray, pos_of: np.ndarray, block_size: int) -> np.ndarray:
+    """
+    Count Mendelian errors for a block of trios; runs in a worker process set up by _init_worker.
+    Args:
+        file_of: (3, trios) array index of child, sire and dam
+        pos_of: (3, trios) .bed position of child, sire and dam
+        block_size: number of variants decoded at once
+    Returns:
+        np.ndarray: (trios, 6) counts of informative trio SNPs, trio errors,
+                    informative sire SNPs, sire errors, informative dam SNPs, dam errors
+    """
+    readers, variant_idx, flips = _worker["readers"], _worker["variant_idx"], _worker["flips"]
+    n_shared = len(variant_idx[0])
+    counts = np.zeros((file_of.shape[1], 6), dtype=np.int64)
+
+    for start in range(0, n_shared, block_size):
+        stop = min(start + block_size, n_shared)
+        (c1, ch, c2, cm), (s1, sh, s2, sm), (d1, dh, d2, dm) = (
+            _planes(_gather(readers, variant_idx, flips, file_of[role], pos_of[role], start, stop))
+            for role in range(3))
+        # packbits pads the last byte with zeros, so padding never counts as informative
+        sire_ok = ~(cm | sm) & (c1 | ch | c2) & (s1 | sh | s2)
+        dam_ok = ~(cm | dm) & (c1 | ch | c2) & (d1 | dh | d2)
+        trio_ok = sire_ok & dam_ok
+        # opposing homozygotes between offspring and one parent
+        sire_err = ((c1 & s2) | (c2 & s1)) & sire_ok
+        dam_err = ((c1 & d2) | (c2 & d1)) & dam_ok
+        # heterozygous offspring of parents homozygous for the same allele
+        trio_err = (sire_err | dam_err | (ch & ((s1 & d1) | (s2 & d2)))) & trio_ok
+
+        counts += np.stack([_count(trio_ok), _count(trio_err), _count(sire_ok), _count(sire_err),
+                            _count(dam_ok), _count(dam_err)], axis=1)
+    return counts
+
+
+@instrumented
+def check_mendel(pedigree: pd.DataFrame, bed_prefixes: List[str], max_error_rate: float = 0.02,
+                 trios_per_task: int = 2000, block_size: int = 20000, n_workers: int = None,
+                 id_col: str = "horse_id", bed_col: str = "bed_id") -> pd.DataFrame:
+    """
+    Count Mendelian inconsistencies of every trio with genotyped offspring, sire and dam.
+    Trios are split into blocks processed by a pool of worker processes; each worker memory-maps
+    the arrays once and compares bit-packed genotype planes of the variants shared by all arrays.
+    Args:
+        pedigree: cleaned pedigree
+        bed_prefixes: PLINK prefixes (path without .bed/.bim/.fam) of the genotype arrays
+        max_error_rate: parent links with a higher offspring-parent error rate are flagged for dropping
+        trios_per_task: number of trios per worker task
+        block_size: number of variants decoded at once
+        n_workers: number of worker processes, os.cpu_count() if None
+        id_col, bed_col: names of the animal id and bed id columns
+    Returns:
+        df: one row per trio with ids, informative SNP and error counts, error rates
+            and drop_sire/drop_dam flags
+    """
+    trios = calc_trios(pedigree, id_col=id_col, bed_col=bed_col)
+    trios = trios[trios["genotyped"]].drop(columns="genotyped").reset_index(drop=True)
+
+    first = pedigree.dropna(subset=[id_col]).drop_duplicates(subset=id_col).set_index(id_col)[bed_col]
+    bed_ids = np.stack([first.loc[trios[col]].to_numpy() for col in ["id", "sire_id", "dam_id"]])
+
+    readers = [BedReader(prefix) for prefix in bed_prefixes]
+    file_of, pos_of = _locate(readers, bed_ids.ravel())
+    file_of, pos_of = file_of.reshape(3, -1), pos_of.reshape(3, -1)
+    on_array = (file_of >= 0).all(axis=0)
+    if not on_array.all():
+        print(f"{int((~on_array).sum())} trios have members missing from the arrays and are skipped")
+    trios, bed_ids = trios[on_array].reset_index(drop=True), bed_ids[:, on_array]
+    file_of, pos_of = file_of[:, on_array], pos_of[:, on_array]
+    variant_idx, flips = _shared_variants(readers)
+    print(f"Checking {len(trios)} genotyped trios on {len(variant_idx[0])} shared variants")
+
+    tasks = range(0, len(trios), trios_per_task)
+    counts = np.zeros((len(trios), 6), dtype=np.int64)
+    with process_pool(n_workers or os.cpu_count(), initializer=_init_worker,
+                      initargs=(bed_prefixes, variant_idx, flips)) as pool:
+        futures = {start: pool.submit(_check_trio_block, file_of[:, start:start + trios_per_task],
+                                      pos_of[:, start:start + trios_per_task], block_size)
+                   for start in tasks}
+        for start, future in futures.items():
+            counts[start:start + trios_per_task] = future.result()
+
+    result = trios.assign(child_bed_id=bed_ids[0], sire_bed_id=bed_ids[1], dam_bed_id=bed_ids[2])
+    for i, col in enumerate(["trio_snps", "trio_errors", "sire_snps", "sire_errors", "dam_snps", "dam_errors"]):
+        result[col] = counts[:, i]
+    for role in ["trio", "sire", "dam"]:
+        result[f"{role}_error_rate"] = result[f"{role}_errors"] / result[f"{role}_snps"].where(result[f"{role}_snps"] > 0)
+    result["drop_sire"] = result["sire_error_rate"] > max_error_rate
+    result["drop_dam"] = result["dam_error_rate"] > max_error_rate
+
+    print(f"Mendelian check has finished: {int(result['drop_sire'].sum())} sire and "
+          f"{int(result['drop_dam'].sum())} dam links exceed the error rate {max_error_rate}")
+    return result
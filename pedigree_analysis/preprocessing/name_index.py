@@ -0,0 +1,154 @@
+"""This module contains the horse name index resolving Pedigree #2 sire and dam names to horse_id"""
+
+import hashlib
+import inspect
+import json
+import os
+from difflib import SequenceMatcher
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from preprocessing.cache import CACHE_DIR
+from preprocessing import founder_dedup
+from preprocessing.founder_dedup import phonetic_key
+from preprocessing.instrument import instrumented
+from preprocessing.normalize import CODE_VERSION as NORMALIZE_VERSION, normalize_column
+
+INDEX_PATH = os.path.join(CACHE_DIR, "name_index.arrow")
+PARENT_SEX = {"sire_id": "1", "dam_id": "2"}
+
+
+def build_name_index(ped: pd.DataFrame) -> pd.DataFrame:
+    """
+    Build the lookup table of normalized horse names.
+    Args:
+        ped: cleaned PedNew dataframe with id, name, YOB and sex
+    Returns:
+        df: one row per animal with horse_id, YOB, sex and the exact (name), compact
+            (name without spaces) and phonetic keys
+    """
+    ped = ped.dropna(subset=["id", "name"]).drop_duplicates(subset="id")
+    name = normalize_column(ped["name"], kind="name").astype(object)
+    index = pd.DataFrame({"horse_id": ped["id"].to_numpy(),
+                          "YOB": pd.to_numeric(ped["YOB"], errors="coerce").to_numpy(),
+                          "sex": ped["sex"].astype(object).to_numpy(),
+                          "name": name.to_numpy()}).dropna(subset=["name"])
+    index["compact"] = index["name"].str.replace(" ", "", regex=False)
+    unique_compact = pd.Series(index["compact"].unique())
+    index["phonetic"] = index["compact"].map(dict(zip(unique_compact, unique_compact.map(phonetic_key))))
+    return index.reset_index(drop=True)
+
+
+@instrumented
+def get_name_index(ped: pd.DataFrame, path: str = INDEX_PATH) -> pd.DataFrame:
+    """
+    Return the name index of a pedigree, loading it from disk if it was built for the same records
+    (in the same order) by the same index code (see CODE_VERSION).
+    Args:
+        ped: cleaned PedNew dataframe
+        path: location of the persisted index
+    Returns:
+        df: name index, see build_name_index
+    """
+    row_hashes = pd.util.hash_pandas_object(ped[["id", "name", "YOB", "sex"]].astype(str), index=False)
+    digest = hashlib.sha256(CODE_VERSION.encode())
+    digest.update(row_hashes.to_numpy().tobytes())
+    fingerprint = digest.hexdigest()
+    if os.path.exists(path):
+        table = feather.read_table(path, memory_map=True)
+        if table.schema.metadata.get(b"fingerprint", b"").decode() == fingerprint:
+            return table.to_pandas()
+
+    index = build_name_index(ped)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.Table.from_pandas(index, preserve_index=False)
+    feather.write_feather(table.replace_schema_metadata({**(table.schema.metadata or {}), "fingerprint": fingerprint}),
+                          path, compression="uncompressed")
+    print(f"Name index of {len(index)} horses saved to {path}")
+    return index
+
+
+def _join(queries: pd.DataFrame, index: pd.DataFrame, key: str, min_age: int, max_age: int) -> pd.DataFrame:
+    """Hash-join queries to the index on a key and keep candidates satisfying sex and age constraints"""
+    candidates = queries.merge(index, on=key, suffixes=("", "_parent"))
+    sex_ok = candidates["sex"].isna() | (candidates["sex"] == candidates["parent_sex"]) | \
+             ~candidates["sex"].isin(["1", "2"])
+    age = candidates["offspring_yob"] - candidates["YOB"]
+    age_ok = age.isna() | age.between(min_age, max_age)
+    return candidates[sex_ok & age_ok]
+
+
+@instrumented
+def resolve_parent_names(ped2nd: pd.DataFrame, index: pd.DataFrame, min_age: int = 2, max_age: int = 30,
+                         min_score: float = 0.85) -> tuple:
+    """
+    Resolve Sire and Dam names of Pedigree #2 to horse_id of PedNew.
+
+    Every name is looked up in tiers, each a single hash join over all unresolved names:
+    exact normalized name, then the name without spaces ("LatinQuarter" vs "latin quarter"),
+    then the phonetic key with a name similarity of at least min_score. Candidates must have
+    the parent's sex and be born min_age to max_age years before the offspring. A name with
+    several candidates in a tier is reported as ambiguous and left unresolved.
+    Args:
+        ped2nd: Pedigree #2 with Sire, Dam and Year of Birth
+        index: name index from get_name_index
+        min_age, max_age: allowed parent age at the birth of the offspring
+        min_score: smallest name similarity (0-1) of the phonetic tier
+    Returns:
+        tuple: (parent_ids, ambiguous) where parent_ids has sire_id, sire_match, dam_id and
+               dam_match aligned with ped2nd, and ambiguous lists every candidate of ambiguous names
+    """
+    offspring_yob = pd.to_numeric(ped2nd["Year of Birth"], errors="coerce")
+    parent_ids = pd.DataFrame(index=ped2nd.index)
+    ambiguous_cols = ["row", "role", "match", "horse_id", "YOB"]
+    # without names to resolve no tier runs, the table is still returned with its columns
+    ambiguous = [pd.DataFrame(columns=ambiguous_cols)]
+
+    for role, col in [("sire_id", "Sire"), ("dam_id", "Dam")]:
+        name = normalize_column(ped2nd[col], kind="name").astype(object)
+        queries = pd.DataFrame({"row": ped2nd.index, "name": name.to_numpy(),
+                                "offspring_yob": offspring_yob.to_numpy(),
+                                "parent_sex": PARENT_SEX[role]}).dropna(subset=["name"])
+        queries["compact"] = queries["name"].str.replace(" ", "", regex=False)
+        queries["phonetic"] = queries["compact"].map(phonetic_key)
+
+        resolved = pd.Series(np.nan, index=ped2nd.index, dtype=object)
+        tier = pd.Series(np.where(ped2nd[col].notna(), "unresolved", None), index=ped2nd.index, dtype=object)
+        for match, key in [("exact", "name"), ("near", "compact"), ("phonetic", "phonetic")]:
+            pending = queries[queries["row"].isin(tier.index[tier == "unresolved"])]
+            if pending.empty:
+                break
+            candidates = _join(pending, index.drop(columns=[k for k in ["name", "compact", "phonetic"] if k != key]),
+                               key, min_age, max_age)
+            if match == "phonetic":
+                candidates = candidates.merge(index[["horse_id", "compact"]], on="horse_id", suffixes=("", "_parent"))
+                score = [SequenceMatcher(None, a, b).ratio()
+                         for a, b in zip(candidates["compact"], candidates["compact_parent"])]
+                candidates = candidates[np.array(score, dtype=float) >= min_score]
+
+            n_candidates = candidates.groupby("row")["horse_id"].nunique()
+            single = n_candidates.index[n_candidates == 1]
+            multiple = n_candidates.index[n_candidates > 1]
+            first = candidates.drop_duplicates(subset="row").set_index("row")["horse_id"]
+            resolved[single] = first[single]
+            tier[single] = match
+            tier[multiple] = "ambiguous"
+            ambiguous.append(candidates[candidates["row"].isin(multiple)]
+                             .assign(role=role, match=match)[ambiguous_cols])
+
+        parent_ids[role] = resolved
+        parent_ids[role.replace("_id", "_match")] = tier
+        counts = tier.value_counts()
+        print(f"{col} names resolved: " + (", ".join(f"{k} {v}" for k, v in counts.items()) or "no names"))
+
+    ambiguous = pd.concat(ambiguous, ignore_index=True)
+    ambiguous.insert(1, "bed_id", ped2nd.loc[ambiguous["row"], "id"].to_numpy())
+    return parent_ids, ambiguous.drop(columns="row")
+
+
+# the index code, phonetic keys and name normalization are part of the index fingerprint,
+# so an index persisted by older code is rebuilt
+CODE_VERSION = hashlib.sha256((inspect.getsource(build_name_index) + inspect.getsource(phonetic_key) +
+                               json.dumps(founder_dedup._SOUNDEX_CODES, sort_keys=True) +
+                               NORMALIZE_VERSION).encode()).hexdigest()[:12]
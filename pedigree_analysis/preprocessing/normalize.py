@@ -0,0 +1,137 @@
+"""This module contains string normalization working on unique values with a persistent vocabulary"""
+
+import atexit
+import hashlib
+import inspect
+import json
+import os
+import numpy as np
+import pandas as pd
+from preprocessing.cache import CACHE_DIR
+
+VOCAB_DIR = os.path.join(CACHE_DIR, "vocabulary")
+
+
+class Vocabulary:
+    """
+    Persistent raw value -> canonical value mappings.
+
+    Mappings are grouped into sections, one per kind of column and normalization rule
+    (e.g. countries unified with country_unific_dict), so values seen in an earlier
+    run or in another column of the same kind are not normalized again. Every section
+    is a file of the vocabulary directory, read when it is first used; save writes only
+    the sections that got new values and removes the files of the same sections written
+    by another normalization code.
+    """
+
+    def __init__(self, path: str = VOCAB_DIR) -> None:
+        self.path = path
+        self.sections = {}
+        self.changed = set()
+
+    def key(self, kind: str, mapping: dict = None, upper: bool = False) -> str:
+        """
+        Return the section key of a kind of column, {kind}_{rule}_{code}: a changed mapping or
+        normalization code gets a fresh section
+        """
+        rule = json.dumps({"mapping": mapping or {}, "upper": upper}, sort_keys=True)
+        return f"{kind}_{hashlib.sha256(rule.encode()).hexdigest()[:12]}_{CODE_VERSION}"
+
+    def section(self, key: str) -> dict:
+        """Return the mappings of a section, loading them on first use"""
+        if key not in self.sections:
+            path = os.path.join(self.path, f"{key}.json") if self.path else None
+            if path and os.path.exists(path):
+                with open(path) as f:
+                    self.sections[key] = json.load(f)
+            else:
+                self.sections[key] = {}
+        return self.sections[key]
+
+    def save(self) -> None:
+        """Write the sections new values were added to, older code versions of them are removed"""
+        if not self.path or not self.changed:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        for key in sorted(self.changed):
+            path = os.path.join(self.path, f"{key}.json")
+            with open(f"{path}.tmp{os.getpid()}", "w") as f:
+                json.dump(self.sections[key], f)
+            os.replace(f"{path}.tmp{os.getpid()}", path)
+            stem = key.rsplit("_", 1)[0]
+            for name in os.listdir(self.path):
+                if name.startswith(f"{stem}_") and name.endswith(".json") and name != f"{key}.json":
+                    try:
+                        os.remove(os.path.join(self.path, name))
+                    except FileNotFoundError:
+                        # removed by another process saving the same section
+                        pass
+        self.changed = set()
+
+
+_vocabulary = None
+
+
+def get_vocabulary() -> Vocabulary:
+    """Return the vocabulary shared by all columns of this run, it is saved once when the process exits"""
+    global _vocabulary
+    if _vocabulary is None:
+        _vocabulary = Vocabulary()
+        atexit.register(_vocabulary.save)
+    return _vocabulary
+
+
+def normalize_values(values: pd.Series) -> pd.Series:
+    """Strip, lower, remove special characters and collapse whitespace with vectorized string ops"""
+    return values.str.strip() \
+                 .str.lower() \
+                 .str.replace(r"[^\w\s]", "", regex=True) \
+                 .str.replace(r"\s+", " ", regex=True)
+
+
+def normalize_column(column: pd.Series, kind: str, mapping: dict = None, upper: bool = False,
+                     vocabulary: Vocabulary = None) -> pd.Series:
+    """
+    Normalize a string column working only on its unique values.
+    Args:
+        column: column to normalize, non-string values become missing
+        kind: kind of values (e.g. "country", "name", "colour"), columns of the same kind share a vocabulary section
+        mapping: normalized value -> canonical value, values missing from it keep their normalized form
+        upper: upper-case the canonical values
+        vocabulary: vocabulary to use, the shared one if None; a given vocabulary is saved by the caller
+    Returns:
+        pd.Series: categorical column with the canonical values and the index of the input
+    """
+    vocabulary = vocabulary or get_vocabulary()
+    key = vocabulary.key(kind, mapping, upper)
+    section = vocabulary.section(key)
+
+    codes, uniques = pd.factorize(column, use_na_sentinel=True)
+    uniques = pd.Series(np.asarray(uniques, dtype=object))
+    is_str = uniques.map(lambda x: isinstance(x, str)).astype(bool)
+    raw = uniques[is_str]
+
+    known = raw.isin(section.keys())
+    new = raw[~known]
+    if len(new) > 0:
+        canonical = normalize_values(new.astype(str))
+        if mapping:
+            canonical = canonical.map(lambda x: mapping.get(x, x))
+        if upper:
+            canonical = canonical.str.upper()
+        section.update(zip(new.tolist(), canonical.tolist()))
+        vocabulary.changed.add(key)
+
+    canonical_of_unique = pd.Series(np.nan, index=uniques.index, dtype=object)
+    canonical_of_unique[is_str] = raw.map(section)
+    canonical_codes, categories = pd.factorize(canonical_of_unique, use_na_sentinel=True)
+
+    # missing values (code -1) pick the appended -1, which also works for columns without any value
+    value_codes = np.append(canonical_codes, -1)[codes]
+    return pd.Series(pd.Categorical.from_codes(value_codes, categories=categories),
+                     index=column.index, name=column.name)
+
+
+# the normalization code is part of the section keys, so edited rules do not reuse canonical values of older code
+CODE_VERSION = hashlib.sha256((inspect.getsource(normalize_values) +
+                               inspect.getsource(normalize_column)).encode()).hexdigest()[:12]
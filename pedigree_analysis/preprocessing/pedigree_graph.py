@@ -0,0 +1,236 @@
+"""This module contains the integer-indexed pedigree graph shared by cleaning and analysis steps"""
+
+import numpy as np
+import pandas as pd
+
+
+class PedigreeGraph:
+    """
+    Pedigree stored as dense integer arrays instead of string-keyed DataFrames.
+
+    Every animal gets a dense int32 index. Parents are kept in `sire_idx`/`dam_idx`
+    (-1 codes an unknown parent) and children in CSR form, so the children of animal i
+    are `child_idx[child_ptr[i]:child_ptr[i + 1]]`. Parent and child lookups are plain
+    array indexing and the memory footprint is a handful of int32 arrays per animal.
+
+    Attributes:
+        ids: pd.Index with the original id of every animal, position equals the dense index
+        sire_idx: int32 array with the sire index of every animal, -1 if unknown
+        dam_idx: int32 array with the dam index of every animal, -1 if unknown
+        row: int64 array with the positional row of every animal in the source frame,
+             -1 for parents that are referenced but have no record of their own
+        child_ptr: int64 CSR offsets into child_idx, length n + 1
+        child_idx: int32 array with the children of all animals grouped by parent
+    """
+
+    def __init__(self, ids: pd.Index, sire_idx: np.ndarray, dam_idx: np.ndarray,
+                 row: np.ndarray) -> None:
+        self.ids = ids
+        self.sire_idx = np.asarray(sire_idx, dtype=np.int32)
+        self.dam_idx = np.asarray(dam_idx, dtype=np.int32)
+        self.row = np.asarray(row, dtype=np.int64)
+        self.child_ptr, self.child_idx = self._build_children()
+
+    @classmethod
+    def from_frame(cls, ped: pd.DataFrame, id_col: str = "id", sire_col: str = "sire_id",
+                   dam_col: str = "dam_id") -> "PedigreeGraph":
+        """
+        Build the graph from a pedigree frame such as the cleaned PedNew sheet.
+        Args:
+            ped: pedigree dataframe, one record per animal (the first record wins for duplicated ids)
+            id_col: name of the animal id column
+            sire_col: name of the sire id column
+            dam_col: name of the dam id column
+        Returns:
+            PedigreeGraph: graph where parents without own records are appended as founders
+        """
+        has_id = ped[id_col].notna().to_numpy()
+        rows = np.flatnonzero(has_id)
+        id_values = ped[id_col].to_numpy()[rows]
+        first = ~pd.Index(id_values).duplicated(keep="first")
+        rows = rows[first]
+        ids = pd.Index(id_values[first])
+
+        sires = ped[sire_col].to_numpy()[rows]
+        dams = ped[dam_col].to_numpy()[rows]
+
+        # parents that are referenced but do not have a record of their own become founders
+        parents = pd.Index(np.concatenate([sires, dams])).dropna().unique()
+        missing = parents[ids.get_indexer(parents) < 0]
+        if len(missing) > 0:
+            ids = ids.append(missing)
+            rows = np.concatenate([rows, np.full(len(missing), -1, dtype=np.int64)])
+
+        n_missing = len(missing)
+        sire_idx = np.concatenate([ids.get_indexer(sires), np.full(n_missing, -1)])
+        dam_idx = np.concatenate([ids.get_indexer(dams), np.full(n_missing, -1)])
+
+        return cls(ids, sire_idx, dam_idx, rows)
+
+    def _build_children(self) -> tuple:
+        """Build CSR child lists from the parent arrays"""
+        n = self.n
+        child = np.arange(n, dtype=np.int32)
+        parent = np.concatenate([self.sire_idx, self.dam_idx])
+        child = np.concatenate([child, child])
+        known = parent >= 0
+        parent, child = parent[known], child[known]
+
+        order = np.argsort(parent, kind="stable")
+        child_idx = child[order].astype(np.int32)
+        counts = np.bincount(parent, minlength=n)
+        child_ptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=child_ptr[1:])
+        return child_ptr, child_idx
+
+    @property
+    def n(self) -> int:
+        """Number of animals in the graph"""
+        return len(self.ids)
+
+    def index_of(self, values) -> np.ndarray:
+        """Return dense indices for the given original ids, -1 for ids not in the graph"""
+        return self.ids.get_indexer(pd.Index(values)).astype(np.int32)
+
+    def id_of(self, idx: np.ndarray) -> np.ndarray:
+        """Return original ids for dense indices, -1 entries become NaN"""
+        idx = np.asarray(idx)
+        out = self.ids.to_numpy(dtype=object)[np.where(idx >= 0, idx, 0)]
+        out[idx < 0] = np.nan
+        return out
+
+    def n_children(self) -> np.ndarray:
+        """Return the number of offspring of every animal"""
+        return np.diff(self.child_ptr)
+
+    def children(self, i: int) -> np.ndarray:
+        """Return dense indices of the offspring of animal i"""
+        return self.child_idx[self.child_ptr[i]:self.child_ptr[i + 1]]
+
+    def children_of(self, nodes: np.ndarray) -> np.ndarray:
+        """Return the concatenated offspring of several animals in one gather"""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        starts = self.child_ptr[nodes]
+        lengths = self.child_ptr[nodes + 1] - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int32)
+        # position of every gathered child inside child_idx
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return self.child_idx[offsets + np.arange(total)]
+
+    def ancestors(self, seeds: np.ndarray, depth: int = None) -> np.ndarray:
+        """
+        Walk up from the seeds one generation per step over the parent arrays.
+        Args:
+            seeds: dense indices of the starting animals
+            depth: number of generations to go back, all generations if None
+        Returns:
+            np.ndarray: int32 distance in generations from the nearest seed, 0 for seeds
+                        and -1 for animals that are not reached
+        """
+        return self._traverse(seeds, depth,
+                              lambda frontier: np.concatenate([self.sire_idx[frontier], self.dam_idx[frontier]]))
+
+    def descendants(self, seeds: np.ndarray, depth: int = None) -> np.ndarray:
+        """
+        Walk down from the seeds one generation per step over the CSR child lists.
+        Args:
+            seeds: dense indices of the starting animals
+            depth: number of generations to go forward, all generations if None
+        Returns:
+            np.ndarray: int32 distance in generations from the nearest seed, 0 for seeds
+                        and -1 for animals that are not reached
+        """
+        return self._traverse(seeds, depth, self.children_of)
+
+    def _traverse(self, seeds: np.ndarray, depth: int, step) -> np.ndarray:
+        """Breadth-first frontier expansion where step maps a frontier to its neighbours"""
+        distance = np.full(self.n, -1, dtype=np.int32)
+        frontier = np.unique(np.asarray(seeds, dtype=np.int64))
+        frontier = frontier[frontier >= 0]
+        generation = 0
+        while frontier.size and (depth is None or generation <= depth):
+            distance[frontier] = generation
+            nxt = step(frontier)
+            nxt = np.unique(nxt[nxt >= 0])
+            frontier = nxt[distance[nxt] < 0]
+            generation += 1
+        return distance
+
+    def topological_levels(self) -> np.ndarray:
+        """
+        Assign every animal its generation level: founders are 0, offspring are one
+        above their latest parent. Levels are propagated frontier by frontier, so the
+        loop runs once per generation, not once per animal.
+        Returns:
+            np.ndarray: int32 level of every animal, -1 for animals in or below a cycle
+        """
+        indegree = (self.sire_idx >= 0).astype(np.int64) + (self.dam_idx >= 0)
+        level = np.full(self.n, -1, dtype=np.int32)
+        frontier = np.flatnonzero(indegree == 0)
+        depth = 0
+        while frontier.size:
+            level[frontier] = depth
+            kids = self.children_of(frontier)
+            indegree -= np.bincount(kids, minlength=self.n)
+            frontier = np.unique(kids[indegree[kids] == 0])
+            depth += 1
+        return level
+
+    def topological_order(self) -> np.ndarray:
+        """
+        Order animals so that parents always come before their offspring.
+        Returns:
+            np.ndarray: dense indices sorted by generation level
+        Raises:
+            ValueError: if the pedigree contains a cycle
+        """
+        level = self.topological_levels()
+        if (level < 0).any():
+            raise ValueError(f"Pedigree contains cycles, {int((level < 0).sum())} animals cannot be ordered")
+        return np.argsort(level, kind="stable").astype(np.int32)
+
+    def node_values(self, column: pd.Series) -> np.ndarray:
+        """
+        Align a column of the source frame with the dense index.
+        Args:
+            column: column of the frame the graph was built from
+        Returns:
+            np.ndarray: value for every animal, NaN for parents without own records
+        """
+        values = column.to_numpy()
+        has_row = self.row >= 0
+        if has_row.all():
+            return values[self.row]
+        out = np.full(self.n, np.nan, dtype=np.result_type(values.dtype, np.float64)
+                      if values.dtype.kind in "biuf" else object)
+        out[has_row] = values[self.row[has_row]]
+        return out
+
+    def __repr__(self) -> str:
+        return f"PedigreeGraph(n={self.n}, links={len(self.child_idx)})"
+
+
+def renumber(graph: PedigreeGraph) -> tuple:
+    """
+    Renumber the pedigree so that parents come before offspring.
+    Args:
+        graph: pedigree graph
+    Returns:
+        tuple: (order, sire, dam, level) where order[k] is the dense index of the animal numbered k + 1,
+               sire/dam are 1-based renumbered parents with 0 for unknown and level is the generation
+               level, all aligned with order
+    Raises:
+        ValueError: if the pedigree contains a cycle
+    """
+    level = graph.topological_levels()
+    order = graph.topological_order()
+    position = np.empty(graph.n, dtype=np.int64)
+    position[order] = np.arange(1, graph.n + 1)
+
+    def renum(parent_idx: np.ndarray) -> np.ndarray:
+        parent = parent_idx[order]
+        return np.where(parent >= 0, position[np.where(parent >= 0, parent, 0)], 0)
+
+    return order, renum(graph.sire_idx), renum(graph.dam_idx), level[order]
@@ -0,0 +1,209 @@
+"""This module contains a memoized runner executing the preprocessing as named stages"""
+
+import hashlib
+import inspect
+import json
+import os
+from types import ModuleType
+from typing import Callable, Dict, List
+import pandas as pd
+from preprocessing.cache import CACHE_DIR
+from preprocessing.instrument import RunReport
+
+PIPELINE_DIR = os.path.join(CACHE_DIR, "pipeline")
+# modules below this directory are part of the stage code hashes
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Stage:
+    """
+    A named pipeline step.
+
+    func is called with the stage inputs as keyword arguments followed by the config
+    entries and returns a dict with every declared output.
+    Attributes:
+        name: stage name, used on the command line
+        func: function computing the stage
+        inputs: names of values produced by upstream stages
+        outputs: names of values the stage produces
+        config: json-serializable parameters of the stage, part of its fingerprint
+        options: parameters that do not change the outputs (e.g. cache use), passed like config
+                 but left out of the fingerprint
+        persist: if False the stage is never memoized (e.g. stages writing result files)
+    """
+
+    def __init__(self, name: str, func: Callable, inputs: List[str], outputs: List[str],
+                 config: dict = None, options: dict = None, persist: bool = True) -> None:
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.config = config or {}
+        self.options = options or {}
+        self.persist = persist
+
+    def code_hash(self) -> str:
+        """
+        Hash the source of the stage function and of every project module it depends on: the
+        modules defining the functions it calls and, transitively, every project module those
+        import from, so editing a helper such as normalize or PedigreeGraph invalidates the stage.
+        """
+        digest = hashlib.sha256(inspect.getsource(self.func).encode())
+        referenced = _referenced(self.func)
+        # helpers defined next to the stage function are hashed by their source
+        for obj in referenced:
+            if inspect.isfunction(obj) and obj.__module__ == self.func.__module__ and obj is not self.func:
+                digest.update(inspect.getsource(obj).encode())
+        modules = [_project_module(obj) for obj in referenced]
+        for module in _reachable([module for module in modules
+                                  if module is not None and module.__name__ != self.func.__module__]):
+            with open(module.__file__, "rb") as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+
+def _referenced(func: Callable) -> list:
+    """
+    Return the global objects named in the code of func, of the functions and lambdas nested in it
+    and of the functions of its own module it calls
+    """
+    codes, names, objects = [func.__code__], set(), {}
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes += [const for const in code.co_consts if inspect.iscode(const)]
+        for name in sorted(names - set(objects)):
+            if name not in func.__globals__:
+                continue
+            obj = objects[name] = func.__globals__[name]
+            if inspect.isfunction(obj) and obj.__module__ == func.__module__:
+                codes.append(obj.__code__)
+    return list(objects.values())
+
+
+def _project_module(obj) -> ModuleType:
+    """Return the project module defining obj (or obj itself if it is one), None for the standard library and packages"""
+    try:
+        # instrumented functions are attributed to the module defining them, not to the decorator
+        module = inspect.getmodule(inspect.unwrap(obj) if callable(obj) else obj)
+    except (TypeError, ValueError):
+        return None
+    path = getattr(module, "__file__", None)
+    if path is None or not os.path.abspath(path).startswith(PROJECT_DIR + os.sep):
+        return None
+    return module
+
+
+def _reachable(modules: List[ModuleType]) -> List[ModuleType]:
+    """Return the modules and every project module they import from, directly or through other modules"""
+    found = {}
+    while modules:
+        module = modules.pop()
+        if module.__name__ in found:
+            continue
+        found[module.__name__] = module
+        for value in list(vars(module).values()):
+            dependency = _project_module(value)
+            if dependency is not None and dependency.__name__ not in found:
+                modules.append(dependency)
+    return [found[name] for name in sorted(found)]
+
+
+class Pipeline:
+    """
+    Runs stages in declaration order and persists their outputs.
+
+    A stage fingerprint combines its code, its config and the fingerprints of the
+    stages producing its inputs, so a rerun only recomputes stages whose code, config
+    or upstream data changed; all other outputs are loaded from store_dir.
+    """
+
+    def __init__(self, stages: List[Stage], store_dir: str = PIPELINE_DIR) -> None:
+        self.stages = stages
+        self.store_dir = store_dir
+        self.producer = {}
+        for stage in stages:
+            for name in stage.inputs:
+                if name not in self.producer:
+                    raise ValueError(f"Input '{name}' of stage '{stage.name}' is not produced by an earlier stage")
+            for name in stage.outputs:
+                self.producer[name] = stage.name
+
+    def names(self) -> List[str]:
+        """Return stage names in execution order"""
+        return [stage.name for stage in self.stages]
+
+    def _position(self, name: str) -> int:
+        if name not in self.names():
+            raise ValueError(f"Unknown stage '{name}', available stages: {', '.join(self.names())}")
+        return self.names().index(name)
+
+    def fingerprints(self) -> Dict[str, str]:
+        """Compute the fingerprint of every stage"""
+        fingerprints = {}
+        for stage in self.stages:
+            upstream = sorted({fingerprints[self.producer[name]] for name in stage.inputs})
+            payload = json.dumps({"name": stage.name, "code": stage.code_hash(), "config": stage.config,
+                                  "upstream": upstream}, sort_keys=True, default=str)
+            fingerprints[stage.name] = hashlib.sha256(payload.encode()).hexdigest()
+        return fingerprints
+
+    def _paths(self, stage: Stage) -> tuple:
+        return (os.path.join(self.store_dir, f"{stage.name}.pkl"),
+                os.path.join(self.store_dir, f"{stage.name}.json"))
+
+    def _load(self, stage: Stage, fingerprint: str):
+        """Return persisted outputs of a stage if they match the fingerprint, otherwise None"""
+        data_path, meta_path = self._paths(stage)
+        if not stage.persist or not os.path.exists(meta_path) or not os.path.exists(data_path):
+            return None
+        with open(meta_path) as f:
+            if json.load(f)["fingerprint"] != fingerprint:
+                return None
+        return pd.read_pickle(data_path)
+
+    def _save(self, stage: Stage, fingerprint: str, outputs: dict) -> None:
+        data_path, meta_path = self._paths(stage)
+        os.makedirs(self.store_dir, exist_ok=True)
+        pd.to_pickle(outputs, data_path)
+        with open(meta_path, "w") as f:
+            json.dump({"fingerprint": fingerprint, "outputs": stage.outputs}, f)
+
+    def run(self, start: str = None, stop: str = None, force: bool = False, report: RunReport = None) -> dict:
+        """
+        Run the stages from start to stop (inclusive).
+        Stages before start are loaded from the store and only computed if nothing valid is stored.
+        Args:
+            start: first stage to run, defaults to the first stage
+            stop: last stage to run, defaults to the last stage
+            force: recompute the selected stages even if valid outputs are stored
+            report: run report recording every stage, see preprocessing.instrument
+        Returns:
+            dict: all values produced up to stop
+        """
+        first = self._position(start) if start else 0
+        last = self._position(stop) if stop else len(self.stages) - 1
+        if first > last:
+            raise ValueError(f"Stage '{start}' comes after stage '{stop}'")
+
+        fingerprints = self.fingerprints()
+        values = {}
+        for position, stage in enumerate(self.stages[:last + 1]):
+            fingerprint = fingerprints[stage.name]
+            outputs = None if (force and position >= first) else self._load(stage, fingerprint)
+            if outputs is not None:
+                print(f"----------Stage '{stage.name}' is up to date, outputs loaded----------")
+                if report is not None:
+                    report.loaded(stage.name, outputs)
+            else:
+                print(f"----------Running stage '{stage.name}'----------")
+                kwargs = {**{name: values[name] for name in stage.inputs}, **stage.config, **stage.options}
+                outputs = stage.func(**kwargs) if report is None else \
+                    report.call("stage", stage.name, stage.func, (), kwargs)
+                missing = set(stage.outputs) - set(outputs)
+                if missing:
+                    raise ValueError(f"Stage '{stage.name}' did not return {sorted(missing)}")
+                if stage.persist:
+                    self._save(stage, fingerprint, outputs)
+            values.update(outputs)
+        return values
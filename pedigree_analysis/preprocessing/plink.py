@@ -0,0 +1,146 @@
+"""This module contains readers for PLINK binary genotype files (.bed/.bim/.fam)"""
+
+import os
+from typing import Iterator
+import numpy as np
+import pandas as pd
+from preprocessing.instrument import instrumented
+
+FAM_COLUMNS = {"fid": str, "iid": str, "father": str, "mother": str, "sex": np.int8, "phenotype": str}
+BIM_COLUMNS = {"chrom": str, "snp": str, "cm": np.float32, "pos": np.int64, "a1": str, "a2": str}
+BED_MAGIC = bytes([0x6C, 0x1B, 0x01])  # the last byte marks the variant-major layout
+MISSING = -1
+
+# 2-bit code -> count of the a1 allele; 0b01 is missing
+_CODE_TO_DOSAGE = np.array([2, MISSING, 1, 0], dtype=np.int8)
+# packed byte -> four decoded samples, the first sample is stored in the lowest bits
+_BYTE_TO_DOSAGE = _CODE_TO_DOSAGE[(np.arange(256)[:, None] >> (2 * np.arange(4))) & 3]
+
+
+@instrumented
+def read_fam_table(name: str) -> pd.DataFrame:
+    """
+    Read a .fam file with its fixed six-column schema.
+    Args:
+        name: path to the .fam file
+    Returns:
+        df: one row per sample in .bed order
+    """
+    return pd.read_csv(name, sep=r"\s+", header=None, names=list(FAM_COLUMNS), dtype=FAM_COLUMNS,
+                       engine="c")
+
+
+def read_bim(name: str) -> pd.DataFrame:
+    """
+    Read a .bim file with its fixed six-column schema.
+    Args:
+        name: path to the .bim file
+    Returns:
+        df: one row per variant in .bed order
+    """
+    return pd.read_csv(name, sep=r"\s+", header=None, names=list(BIM_COLUMNS), dtype=BIM_COLUMNS,
+                       engine="c")
+
+
+class BedReader:
+    """
+    Memory-mapped reader of a variant-major PLINK .bed file.
+
+    Nothing but the .fam and .bim tables is loaded into memory. `packed` returns
+    zero-copy views of the 2-bit packed genotypes of a variant range and
+    `read_dosages` decodes only the bytes holding the requested samples.
+    Attributes:
+        fam: sample table from the .fam file
+        bim: variant table from the .bim file
+        n_samples: number of samples
+        n_variants: number of variants
+        bytes_per_variant: number of bytes holding one variant of all samples
+    """
+
+    def __init__(self, prefix: str) -> None:
+        self.prefix = prefix
+        self.fam = read_fam_table(f"{prefix}.fam")
+        self.bim = read_bim(f"{prefix}.bim")
+        self.n_samples = len(self.fam)
+        self.n_variants = len(self.bim)
+        self.bytes_per_variant = (self.n_samples + 3) // 4
+        self._sample_index = pd.Index(self.fam["iid"])
+
+        bed_name = f"{prefix}.bed"
+        expected = len(BED_MAGIC) + self.n_variants * self.bytes_per_variant
+        if os.path.getsize(bed_name) != expected:
+            raise ValueError(f"{bed_name} has {os.path.getsize(bed_name)} bytes, "
+                             f"expected {expected} for {self.n_samples} samples and {self.n_variants} variants")
+        with open(bed_name, "rb") as f:
+            if f.read(len(BED_MAGIC)) != BED_MAGIC:
+                raise ValueError(f"{bed_name} is not a variant-major PLINK .bed file")
+
+        self._bed = np.memmap(bed_name, dtype=np.uint8, mode="r", offset=len(BED_MAGIC),
+                              shape=(self.n_variants, self.bytes_per_variant))
+
+    def sample_index(self, bed_ids) -> np.ndarray:
+        """
+        Return .bed positions of samples.
+        Args:
+            bed_ids: iterable of bed ids (the IID column of the .fam file)
+        Returns:
+            np.ndarray: int64 sample positions
+        Raises:
+            ValueError: if some bed ids are not in the .fam file
+        """
+        positions = self._sample_index.get_indexer(pd.Index(list(bed_ids)))
+        if (positions < 0).any():
+            missing = pd.Index(list(bed_ids))[positions < 0]
+            raise ValueError(f"{len(missing)} bed ids are not in {self.prefix}.fam, e.g. {missing[:5].tolist()}")
+        return positions.astype(np.int64)
+
+    def packed(self, start: int = 0, stop: int = None) -> np.ndarray:
+        """Return a zero-copy (variants x bytes) view of the packed genotypes of a variant range"""
+        return self._bed[start:self.n_variants if stop is None else stop]
+
+    def read_dosages(self, bed_ids=None, start: int = 0, stop: int = None) -> np.ndarray:
+        """
+        Decode genotypes of the selected samples and variant range.
+        Args:
+            bed_ids: samples to decode, all samples if None
+            start: first variant
+            stop: variant after the last one, the end of the file if None
+        Returns:
+            np.ndarray: int8 (samples x variants) counts of the a1 allele, -1 for missing
+        """
+        block = self.packed(start, stop)
+        if bed_ids is None:
+            dosages = _BYTE_TO_DOSAGE[block].reshape(len(block), -1)[:, :self.n_samples]
+            return np.ascontiguousarray(dosages.T)
+
+        positions = self.sample_index(bed_ids)
+        shifts = (2 * (positions % 4)).astype(np.uint8)
+        codes = (block[:, positions // 4] >> shifts) & 3
+        return np.ascontiguousarray(_CODE_TO_DOSAGE[codes].T)
+
+    def read_codes(self, positions: np.ndarray, variants) -> np.ndarray:
+        """
+        Extract raw 2-bit genotype codes without decoding them.
+        Args:
+            positions: .bed positions of the samples (see sample_index)
+            variants: slice or integer array of variants
+        Returns:
+            np.ndarray: uint8 (samples x variants) codes, 0 hom a1, 1 missing, 2 het, 3 hom a2
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        block = self._bed[variants]
+        shifts = (2 * (positions % 4)).astype(np.uint8)
+        return np.ascontiguousarray(((block[:, positions // 4] >> shifts) & 3).T)
+
+    def iter_dosages(self, bed_ids=None, block_size: int = 10000) -> Iterator[tuple]:
+        """
+        Decode genotypes in blocks of variants so the whole matrix is never in memory.
+        Args:
+            bed_ids: samples to decode, all samples if None
+            block_size: number of variants per block
+        Yields:
+            tuple: (start, stop, dosages) with dosages as returned by read_dosages
+        """
+        for start in range(0, self.n_variants, block_size):
+            stop = min(start + block_size, self.n_variants)
+            yield start, stop, self.read_dosages(bed_ids, start, stop)
@@ -0,0 +1,226 @@
+"""This module contains the registry of pedigree and genotype array sources and their concurrent loading
+
+A registry is a JSON file listing the sources of every kind; paths are relative to the registry file:
+    {
+      "pedigree1": [{"name": "main", "path": "data/raw_pedigree_part1.xlsx"}],
+      "pedigree2": [{"name": "batch_2023", "path": "data/raw_pedigree_part2.csv",
+                     "columns": {"Sire Name": "Sire", "Dam Name": "Dam"}}],
+      "arrays": [{"name": "TB_11K", "prefix": "/data/raw_data/TB_11K"}]
+    }
+pedigree1 sources hold the PedIDMatch, PedNew and GenotypeIDs tables, either as sheets of one
+workbook ("path", sheet names can be changed with "sheets": {table: sheet}) or as one csv per
+table ("files": {table: path}); their "columns" map raw to schema column names per table.
+pedigree2 sources are csv files (or one sheet of a workbook, "sheet") in the Pedigree #2 format
+with "columns" mapping raw to schema column names. arrays are PLINK prefixes, the .fam file of
+each gives its bed ids.
+"""
+
+import json
+import os
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from preprocessing.cache import file_hash, frame_from_arrow
+from preprocessing.instrument import instrumented, process_pool, record_worker, run_in_worker, worker_settings
+from preprocessing.load_data import read_table
+from preprocessing.plink import read_fam_table
+
+SOURCES_PATH = "sources.json"
+KINDS = ["pedigree1", "pedigree2", "arrays"]
+# columns of the tables of the common schema, all of them strings
+SCHEMAS = {
+    "pedid_match": ["Equinome ID", "Horse Name", "horse_id"],
+    "ped_df": ["id", "status", "name", "sire_id", "dam_id", "YOB", "sex", "colour", "COB"],
+    "geno_id": ["id", "batchID", "equinomeID", "SNPChip", "Year of Birth", "sex", "Country Reported"],
+    "ped_addit": ["id", "batchID", "equinomeID", "SNPChip", "Year of Birth", "sex", "Country Reported",
+                  "Horse Name", "Sire", "Dam", "Month of Birth", "Country of Birth"],
+}
+# columns every source of a table has to provide
+REQUIRED = {"pedid_match": ["Equinome ID", "horse_id"], "ped_df": ["id", "sire_id", "dam_id"],
+            "geno_id": ["id", "equinomeID", "SNPChip", "batchID"], "ped_addit": ["id", "equinomeID", "SNPChip",
+                                                                               "batchID"]}
+PEDIGREE1_SHEETS = {"pedid_match": "PedIDMatch", "ped_df": "PedNew", "geno_id": "GenotypeIDs"}
+
+
+def load_registry(path: str = SOURCES_PATH) -> dict:
+    """
+    Read a source registry and resolve its paths relative to the registry file.
+    Raises:
+        ValueError: if the registry is not valid, see file_tasks
+    """
+    with open(path) as f:
+        registry = json.load(f)
+    base = os.path.dirname(path)
+
+    def resolve(value: str) -> str:
+        return os.path.normpath(os.path.join(base, value))
+
+    for source in registry.get("pedigree1", []):
+        if "path" in source:
+            source["path"] = resolve(source["path"])
+        if "files" in source:
+            source["files"] = {table: resolve(value) for table, value in source["files"].items()}
+    for source in registry.get("pedigree2", []):
+        if "path" in source:
+            source["path"] = resolve(source["path"])
+    for source in registry.get("arrays", []):
+        if "prefix" in source:
+            source["prefix"] = resolve(source["prefix"])
+    file_tasks(registry)
+    return registry
+
+
+def file_tasks(registry: dict) -> List[dict]:
+    """
+    Turn the registry into one loading task per file: a workbook with several tables is read once.
+    Returns:
+        list: tasks with kind, source name, path, tables (table -> sheet, None for csv files) and column maps
+    Raises:
+        ValueError: on unknown kinds or tables, sources without name or path and names used twice
+    """
+    unknown = set(registry) - set(KINDS)
+    if unknown:
+        raise ValueError(f"Unknown source kinds {sorted(unknown)}, expected {', '.join(KINDS)}")
+    names = [source.get("name") for kind in KINDS for source in registry.get(kind, [])]
+    if None in names:
+        raise ValueError("Every source needs a name")
+    duplicated = sorted({name for name in names if names.count(name) > 1})
+    if duplicated:
+        raise ValueError(f"Source names {duplicated} are used more than once")
+
+    tasks = []
+    for source in registry.get("pedigree1", []):
+        columns = source.get("columns", {})
+        if "files" in source:
+            unknown = set(source["files"]) - set(PEDIGREE1_SHEETS)
+            if unknown:
+                raise ValueError(f"Source '{source['name']}' has unknown tables {sorted(unknown)}")
+            tasks += [{"kind": "pedigree1", "source": source["name"], "path": path, "tables": {table: None},
+                       "columns": columns} for table, path in source["files"].items()]
+        elif "path" in source:
+            tasks.append({"kind": "pedigree1", "source": source["name"], "path": source["path"],
+                          "tables": {**PEDIGREE1_SHEETS, **source.get("sheets", {})}, "columns": columns})
+        else:
+            raise ValueError(f"Source '{source['name']}' needs a path or files")
+    for source in registry.get("pedigree2", []):
+        if "path" not in source:
+            raise ValueError(f"Source '{source['name']}' needs a path")
+        tasks.append({"kind": "pedigree2", "source": source["name"], "path": source["path"],
+                      "tables": {"ped_addit": source.get("sheet")},
+                      "columns": {"ped_addit": source.get("columns", {})}})
+    for source in registry.get("arrays", []):
+        if "prefix" not in source:
+            raise ValueError(f"Source '{source['name']}' needs a prefix")
+        tasks.append({"kind": "arrays", "source": source["name"], "path": f"{source['prefix']}.fam"})
+    return tasks
+
+
+def source_hashes(registry: dict) -> Dict[str, str]:
+    """Content hash of every file of the registry, part of the loading stage fingerprint"""
+    return {task["path"]: file_hash(task["path"]) for task in file_tasks(registry)}
+
+
+def arrow_schema(table: str) -> pa.Schema:
+    """Arrow schema of a table of the common schema"""
+    return pa.schema([pa.field(col, pa.string()) for col in SCHEMAS[table]])
+
+
+def to_schema(df: pd.DataFrame, table: str, columns: dict = None, source: str = None) -> pa.Table:
+    """
+    Bring a raw table to the common schema: columns are renamed with columns (raw -> schema name),
+    put in the schema order, missing optional columns are added empty and extra columns dropped.
+    Mapped raw columns that do not exist and optional columns left empty are reported, so a typo
+    in the registry does not silently empty e.g. the Sire and Dam columns.
+    The result is an Arrow table, which moves between processes without pickling every string.
+    Raises:
+        ValueError: if a required column is missing
+    """
+    columns = columns or {}
+    unknown = [raw for raw in columns if raw not in df.columns]
+    if unknown:
+        print(f"Warning: source '{source}' maps columns {unknown} that are not in its {table} table")
+    df = df.rename(columns=columns)
+    missing = [col for col in REQUIRED[table] if col not in df.columns]
+    if missing:
+        raise ValueError(f"Source '{source}' has no columns {missing} for {table}, map them in the registry")
+    empty = [col for col in SCHEMAS[table] if col not in df.columns]
+    if empty:
+        print(f"Warning: source '{source}' has no columns {empty} for {table} and no mapping for them, "
+              f"they are left empty")
+    df = df.reindex(columns=SCHEMAS[table])
+    if table == "ped_addit":
+        # exported Pedigree #2 sheets end with empty rows
+        df = df[df["id"].notna().to_numpy()]
+    return pa.Table.from_pandas(df, schema=arrow_schema(table), preserve_index=False)
+
+
+def _load_file(task: dict, use_cache: bool) -> dict:
+    """Load one file of the registry, runs in a worker process"""
+    if task["kind"] == "arrays":
+        return {"bed_ids": read_fam_table(task["path"])["iid"].to_numpy(dtype=object)}
+    parsed = read_table(task["path"], use_cache=use_cache)
+    tables = {}
+    for table, sheet in task["tables"].items():
+        if isinstance(parsed, pd.DataFrame):
+            df = parsed
+        elif sheet is None:
+            df = next(iter(parsed.values()))
+        elif sheet in parsed:
+            df = parsed[sheet]
+        else:
+            raise ValueError(f"Source '{task['source']}' has no sheet '{sheet}' in {task['path']}")
+        tables[table] = to_schema(df, table, task["columns"].get(table), task["source"])
+    return tables
+
+
+def bed_index(arrays: List[np.ndarray]) -> pd.Index:
+    """Union of the bed ids of all arrays as a hashed index, membership tests are hash lookups"""
+    if not arrays:
+        return pd.Index([], dtype=object)
+    return pd.Index(np.concatenate(arrays)).unique()
+
+
+@instrumented
+def load_sources(registry: dict, n_workers: int = None, use_cache: bool = True) -> dict:
+    """
+    Load every file of the registry concurrently into the common schema.
+    Files are parsed on a pool of worker processes (sheet and csv parsing holds the GIL), so the
+    loading time is that of the slowest file rather than the sum; tables of several sources are
+    concatenated in registry order. Every file load is measured in its worker and added to the
+    run report as a call of this function.
+    Args:
+        registry: registry from load_registry
+        n_workers: number of worker processes, one per file up to os.cpu_count() if None
+        use_cache: read through the parsed file cache
+    Returns:
+        dict: pedid_match, ped_df, geno_id, ped_addit dataframes and bed_ids, the index of bed ids of all arrays
+    """
+    tasks = file_tasks(registry)
+    loaded = []
+    if tasks:
+        settings = worker_settings()
+        with process_pool(min(len(tasks), n_workers or os.cpu_count())) as pool:
+            futures = [pool.submit(run_in_worker, settings, "_load_file", _load_file, task, use_cache)
+                       for task in tasks]
+            loaded = [future.result() for future in futures]
+        for task, (_, record) in zip(tasks, loaded):
+            if record is not None:
+                record_worker({**record, "source": task["source"], "path": task["path"]})
+        loaded = [result for result, _ in loaded]
+
+    tables = {table: [] for table in SCHEMAS}
+    arrays = []
+    for task, result in zip(tasks, loaded):
+        if task["kind"] == "arrays":
+            arrays.append(result["bed_ids"])
+            print(f"{task['source']}: {len(result['bed_ids'])} bed ids")
+            continue
+        for table, data in result.items():
+            tables[table].append(data)
+            print(f"{task['source']}: {len(data)} {table} records")
+
+    values = {table: frame_from_arrow(pa.concat_tables(data) if data else arrow_schema(table).empty_table())
+              for table, data in tables.items()}
+    values["bed_ids"] = bed_index(arrays)
+    return values
@@ -3,15 +3,18 @@
 import pandas as pd
 import os
 from typing import Union
-import re
+from preprocessing.normalize import normalize_column
+from preprocessing.export import write_parquet, write_arrow
+
+SEX_CODES = {"Female": "2", "Male": "1"}
 
 def save_file(data: Union[pd.DataFrame, set], path: str, filename: str) -> None:
     """
-    Save a DataFrame or a set to a CSV file.
+    Save a DataFrame or a set to a CSV file; DataFrames can also be saved as Parquet or Arrow.
     Args:
         data: the data to save, either a pandas DataFrame or a python set
         path: the directory path where the file will be saved
-        filename: the name of the output CSV file
+        filename: the name of the output file, .csv, .parquet or .arrow
     Returns:
         None
     Raises:
@@ -21,11 +24,17 @@ def save_file(data: Union[pd.DataFrame, set], path: str, filename: str) -> None:
     if not os.path.exists(path):
         raise FileNotFoundError(f"The directory {path} does not exist.")
     
+    file_path = os.path.join(path, filename)
+    if isinstance(data, pd.DataFrame) and filename.endswith(".parquet"):
+        write_parquet(data, file_path)
+        return
+    if isinstance(data, pd.DataFrame) and filename.endswith(".arrow"):
+        write_arrow(data, file_path)
+        return
+
     if not filename.endswith(".csv"):
         raise ValueError("The filename must end with .csv")
     
-    file_path = os.path.join(path, filename)
-    
     if isinstance(data, pd.DataFrame):
         data.to_csv(path_or_buf=file_path, sep=",", index=False)
     elif isinstance(data, set):
@@ -33,17 +42,11 @@ def save_file(data: Union[pd.DataFrame, set], path: str, filename: str) -> None:
         df.to_csv(path_or_buf=file_path, sep=",", index=False, header=False)
     print(f"File saved to {file_path}")
 
-def clear_string_val(text: pd.Series) -> pd.Series:
-    """Cleans the input text by stripping, lowering, and removing special characters"""
-    text = text.apply(lambda x: str(x).strip().lower() if isinstance(x, str) else x)
-    text = text.apply(lambda x: re.sub(r'[^\w\s]', '', x) if isinstance(x, str) else x)
-    text = text.apply(lambda x: re.sub(r'\s+', ' ', x) if isinstance(x, str) else x)
-    return text
+def clear_string_val(text: pd.Series, kind: str = "text") -> pd.Series:
+    """Cleans the input text by stripping, lowering, and removing special characters; returns a categorical column"""
+    return normalize_column(text, kind=kind)
 
 def change_sex(text: pd.Series) -> pd.Series:
-    """"""
-    if text.str.contains("Female").any():
-        text = text.map({"Female": 2, "Male": 1}).fillna(0).astype(int).astype(str)
-    else:
-        text = text.fillna(0).astype(str)
-    return text
\ No newline at end of file
+    """Code Pedigree #2 sexes like Pedigree #1: "1" male, "2" female and "0" for anything else, whatever the
+    other values of the column are (a batch may hold one sex only)"""
+    return text.map(SEX_CODES).fillna("0").astype(str)
\ No newline at end of file
@@ -0,0 +1,116 @@
+"""This module contains the whole-pedigree logical validation working on integer parent arrays"""
+
+import numpy as np
+import pandas as pd
+from preprocessing.instrument import instrumented, record_dropped
+from preprocessing.pedigree_graph import PedigreeGraph
+
+VIOLATION_COLUMNS = ["id", "check", "parent_role", "parent_id", "detail"]
+# violations that are fixed by removing the parent link
+LINK_CHECKS = ["parent_younger", "self_parent"]
+
+
+def _violations(graph: PedigreeGraph, mask: np.ndarray, check: str, role: str = None,
+                parent_idx: np.ndarray = None, detail=None) -> pd.DataFrame:
+    """
+    Turn a boolean mask over animals into rows of the violation table.
+    detail is one text for all rows or a function formatting the texts of the flagged animal indices,
+    so only flagged animals are formatted.
+    """
+    idx = np.flatnonzero(mask)
+    parent = graph.id_of(parent_idx[idx]) if parent_idx is not None else np.full(len(idx), np.nan, dtype=object)
+    if detail is None:
+        detail = ""
+    elif callable(detail):
+        detail = np.asarray(detail(idx), dtype=object)
+    return pd.DataFrame({"id": graph.id_of(idx), "check": check, "parent_role": role,
+                         "parent_id": parent, "detail": detail})
+
+
+@instrumented
+def validate_pedigree(ped: pd.DataFrame, graph: PedigreeGraph = None, min_interval: int = 2,
+                      max_interval: int = 30, id_col: str = "id", sire_col: str = "sire_id",
+                      dam_col: str = "dam_id") -> pd.DataFrame:
+    """
+    Run every logical check of the pedigree and collect all violations.
+
+    Checks:
+        multiple_parents: an id has records with different sires or dams
+        sex_role: a male used as a dam, a female used as a sire or an animal used as both
+        self_parent: an animal is its own sire or dam
+        parent_younger: a parent born after its offspring
+        generation_interval: parent age at the birth of the offspring outside min_interval..max_interval
+        cycle: an animal is its own ancestor or descends from such an animal
+    Args:
+        ped: pedigree dataframe with id, sire_id, dam_id, YOB and sex
+        graph: pedigree graph built from ped, it is built here if not provided
+        min_interval, max_interval: plausible parent age in years at the birth of the offspring
+        id_col, sire_col, dam_col: names of the animal and parent id columns
+    Returns:
+        df: one row per violation with id, check, parent_role, parent_id and detail
+    """
+    if graph is None:
+        graph = PedigreeGraph.from_frame(ped, id_col=id_col, sire_col=sire_col, dam_col=dam_col)
+    found = []
+
+    # records of the same id disagreeing on parents; only duplicated ids are grouped
+    dup = ped[ped[id_col].duplicated(keep=False) & ped[id_col].notna()]
+    if not dup.empty:
+        n_parents = dup.groupby(id_col)[[sire_col, dam_col]].nunique()
+        multi = n_parents[(n_parents[sire_col] > 1) | (n_parents[dam_col] > 1)]
+        found.append(pd.DataFrame({"id": multi.index, "check": "multiple_parents", "parent_role": None,
+                                   "parent_id": np.nan,
+                                   "detail": [f"{s} sires, {d} dams" for s, d in zip(multi[sire_col], multi[dam_col])]}))
+
+    sex = graph.node_values(ped["sex"].astype(object))
+    is_sire = np.bincount(graph.sire_idx[graph.sire_idx >= 0], minlength=graph.n) > 0
+    is_dam = np.bincount(graph.dam_idx[graph.dam_idx >= 0], minlength=graph.n) > 0
+    found.append(_violations(graph, is_sire & (sex == "2"), "sex_role", detail="female used as sire"))
+    found.append(_violations(graph, is_dam & (sex == "1"), "sex_role", detail="male used as dam"))
+    found.append(_violations(graph, is_sire & is_dam, "sex_role", detail="used as sire and dam"))
+
+    yob = pd.to_numeric(pd.Series(graph.node_values(ped["YOB"])), errors="coerce").to_numpy(dtype=float)
+    self_idx = np.arange(graph.n)
+    for role, parent_idx in [("sire", graph.sire_idx), ("dam", graph.dam_idx)]:
+        known = parent_idx >= 0
+        found.append(_violations(graph, parent_idx == self_idx, "self_parent", role, parent_idx))
+
+        parent_yob = np.full(graph.n, np.nan)
+        parent_yob[known] = yob[parent_idx[known]]
+        interval = yob - parent_yob
+
+        def detail(idx: np.ndarray) -> list:
+            return [f"parent age {a:g}" for a in interval[idx]]
+
+        found.append(_violations(graph, interval < 0, "parent_younger", role, parent_idx, detail))
+        found.append(_violations(graph, (interval >= 0) & ((interval < min_interval) | (interval > max_interval))
+                                 & (parent_idx != self_idx),
+                                 "generation_interval", role, parent_idx, detail))
+
+    level = graph.topological_levels()
+    found.append(_violations(graph, level < 0, "cycle", detail="in or below a cycle"))
+
+    violations = pd.concat([df for df in found if not df.empty], ignore_index=True) \
+        if any(not df.empty for df in found) else pd.DataFrame(columns=VIOLATION_COLUMNS)
+    return violations[VIOLATION_COLUMNS]
+
+
+@instrumented
+def fix_violations(ped: pd.DataFrame, violations: pd.DataFrame, id_col: str = "id", sire_col: str = "sire_id",
+                   dam_col: str = "dam_id") -> pd.DataFrame:
+    """
+    Remove parent links reported as parent_younger or self_parent, for sires and dams alike.
+    Args:
+        ped: pedigree dataframe, modified in place
+        violations: table from validate_pedigree
+        id_col, sire_col, dam_col: names of the animal and parent id columns
+    Returns:
+        df: fixed pedigree
+    """
+    links = violations[violations["check"].isin(LINK_CHECKS)]
+    for role, col in [("sire", sire_col), ("dam", dam_col)]:
+        wrong_ids = links.loc[links["parent_role"] == role, "id"]
+        ped.loc[ped[id_col].isin(wrong_ids), col] = np.nan
+    for check, n in links["check"].value_counts().items():
+        record_dropped(f"{check}_link", n)
+    return ped
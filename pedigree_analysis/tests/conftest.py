@@ -0,0 +1,9 @@
+"""Test setup: the project modules are importable and caches and state go to a temporary directory"""
+
+import os
+import sys
+import tempfile
+
+# set before the project modules are imported, they read it once
+os.environ.setdefault("PEDIGREE_CACHE_DIR", tempfile.mkdtemp(prefix="pedigree_cache_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,46 @@
+"""Tests of the incremental (delta) ingestion of genotyping batches"""
+
+import pandas as pd
+from preprocessing.genotype_dedup import DEFAULT_RULES, EXCLUSION_COLUMNS
+from preprocessing.incremental import apply_batch
+from preprocessing.sources import SCHEMAS
+
+COL_ORDER = ["horse_id", "status", "horse_name", "sire_id", "dam_id", "YOB", "MOB", "sex", "colour", "COB",
+             "equinome_id", "bed_id", "batch", "snp_chip", "country_reported", "genotyped"]
+
+
+def _state() -> dict:
+    pedigree = pd.DataFrame([["1", "1", "old sire", None, None, 2005, None, "1", "b", "GB",
+                              "EQ1", "20200101_EQ1", "20200101", "SNP50", "GB", True],
+                             ["2", "1", "old dam", None, None, 2006, None, "2", "b", "GB",
+                              None, None, None, None, None, False]], columns=COL_ORDER)
+    return {"pedigree": pedigree, "exclusions": pd.DataFrame(columns=EXCLUSION_COLUMNS)}
+
+
+def _batch(rows: list) -> pd.DataFrame:
+    return pd.DataFrame(rows, columns=SCHEMAS["ped_addit"])
+
+
+def test_single_sex_batch_is_coded():
+    batch = _batch([["20230101_C1", "20230101", "C1", "SNP670", "2022", "Male", "GB", "colt one",
+                     "old sire", "old dam", "May", "GB"],
+                    ["20230101_C2", "20230101", "C2", "SNP670", "2022", "Male", "GB", "colt two",
+                     None, None, "May", "GB"]])
+    state, diff = apply_batch(_state(), batch, pd.Index(batch["id"]), DEFAULT_RULES, {}, COL_ORDER)
+
+    added = diff["added"].set_index("horse_id")
+    assert added["sex"].astype(str).tolist() == ["1", "1"]
+    assert added.loc["20230101_C1", "sire_id"] == "1"
+    assert len(state["pedigree"]) == 4
+
+
+def test_not_in_fam_records_are_checked_again():
+    batch = _batch([["20230101_F1", "20230101", "F1", "SNP670", "2022", "Female", "GB", "filly one",
+                     None, None, "May", "GB"]])
+    state, diff = apply_batch(_state(), batch, pd.Index(["other"]), DEFAULT_RULES, {}, COL_ORDER)
+    assert diff["added"].empty
+    assert diff["exclusions"]["reason"].tolist() == ["not_in_fam"]
+
+    state, diff = apply_batch(state, batch, pd.Index(batch["id"]), DEFAULT_RULES, {}, COL_ORDER)
+    assert diff["added"]["horse_id"].tolist() == ["20230101_F1"]
+    assert diff["added"]["sex"].astype(str).tolist() == ["2"]